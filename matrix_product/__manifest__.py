@@ -22,7 +22,7 @@ work the same way as the studio field, since we do not use Studio field for deve
     'license': 'OEEL-1',
 
     'category': 'Custom Development',
-    'version': '0.1',
+    'version': '0.2',
 
     # any module necessary for this one to work correctly
     'depends': ['product','stock','sale'],
@@ -31,6 +31,7 @@ work the same way as the studio field, since we do not use Studio field for deve
     'data': [
         'security/ir.model.access.csv',
         'data/product_sequence.xml',
+        'data/product_actions.xml',
         'views/product_views_inherits.xml',
         'views/product_group.xml',
         'views/product_group_list.xml',
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import odoo
+from odoo import api, http
+from odoo.http import content_disposition, request
+
+
+class CatalogExport(http.Controller):
+
+    @http.route('/matrix_product/export/catalog', type='http', auth='user')
+    def export_catalog(self, labels=0, **kw):
+        """ Stream the catalog as CSV, or as label sheet rows with ``labels``
+            labels per row, see product.product._export_catalog(). """
+        request.env['product.product'].check_access_rights('read')
+        dbname, uid, context = request.db, request.uid, dict(request.context)
+        label_columns = int(labels)
+
+        def generate():
+            # the request cursor and environments are released before the
+            # response is streamed
+            with api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                for line in env['product.product']._export_catalog(label_columns=label_columns):
+                    yield line.encode('utf-8')
+
+        filename = 'labels.csv' if label_columns else 'catalog.csv'
+        return http.Response(generate(), headers=[
+            ('Content-Type', 'text/csv; charset=utf-8'),
+            ('Content-Disposition', content_disposition(filename)),
+        ], direct_passthrough=True)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tools import sql
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # create the column beforehand so that the registry does not compute the
+    # sequence of every existing product at once, see post-migrate
+    for table in ('product_template', 'product_product'):
+        if not sql.column_exists(cr, table, 'seq'):
+            sql.create_column(cr, table, 'seq', 'int4')
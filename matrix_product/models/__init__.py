@@ -1,3 +1,6 @@
 # -*- coding: utf-8 -*-
+from . import ir_sequence
 from . import product
-from . import product_group
\ No newline at end of file
+from . import product_group
+from . import product_import
+from . import sale_order
\ No newline at end of file
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+class IrSequence(models.Model):
+    _inherit = 'ir.sequence'
+
+    def _next_block(self, count):
+        """ Reserve ``count`` numbers of this sequence in a single database
+            operation and return them formatted, in allocation order.
+            Date range sequences fall back to one allocation per number. """
+        self.ensure_one()
+        if count <= 0:
+            return []
+        if self.use_date_range:
+            return [self._next() for i in range(count)]
+        if self.implementation == 'standard':
+            self._cr.execute(
+                "SELECT nextval(%s) FROM generate_series(1, %s)",
+                ('ir_sequence_%03d' % self.id, count))
+            numbers = [row[0] for row in self._cr.fetchall()]
+        else:
+            # no_gap: lock the row once and move number_next past the whole block
+            self._cr.execute(
+                "SELECT number_next, number_increment FROM ir_sequence WHERE id=%s FOR UPDATE NOWAIT",
+                (self.id,))
+            number_next, number_increment = self._cr.fetchone()
+            self._cr.execute(
+                "UPDATE ir_sequence SET number_next=number_next+%s WHERE id=%s",
+                (number_increment * count, self.id))
+            self.invalidate_cache(['number_next'], self.ids)
+            numbers = [number_next + i * number_increment for i in range(count)]
+        return [self.get_next_char(number) for number in numbers]
+
+    def _sequence_counter(self, number):
+        """ Return the counter of this sequence that formatted as ``number``,
+            the integer value of one of its numbers, or 0 for no number. """
+        self.ensure_one()
+        if not number:
+            return 0
+        prefix, suffix = self._get_prefix_suffix()
+        value = str(number)
+        if prefix and value.startswith(prefix):
+            value = value[len(prefix):]
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        return int(value) if value.isdigit() else 0
@@ -1,64 +1,416 @@
 # -*- coding: utf-8 -*-
 
+import csv
+import io
+import logging
+from collections import Counter
+
 from odoo import api, models, fields, _
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+from odoo.tools.lru import LRU
 
-class ProductTemplate(models.Model):
-    _inherit = 'product.template'
+_logger = logging.getLogger(__name__)
 
-    show_portal = fields.Boolean(string="Don't Show on Portal")
-    product_group = fields.Many2one('matrix_product.productgroup',
-        string='Product Group', required=True)
+# per-worker barcode -> product.product id cache, by database, see Product.resolve_many()
+BARCODE_CACHE_SIZE = 16384
+_barcode_cache = {}
+# postgres sequence bumped to make all the workers drop their barcode cache
+BARCODE_SIGNALING = 'matrix_product_barcode_signaling'
+
+
+def _barcode_sequence(barcode):
+    """ Return the sequence number found after the dot of a barcode, or 0. """
+    suffix = barcode and barcode.partition('.')[2]
+    if suffix and suffix.isdigit() and len(suffix) < 10:
+        return int(suffix)
+    return 0
+
+
+class SequenceMixin(models.AbstractModel):
+    _name = 'matrix_product.sequence.mixin'
+    _description = 'Product Barcode Sequence Mixin'
 
     seq = fields.Integer(
         string='Sequence',
-        default=0,
-        compute='_compute_sequence'
+        compute='_compute_sequence',
+        store=True,
+        index=True,
+        readonly=True,
+        copy=False
          )
-        
-    @api.depends('barcode')
+
+    @api.depends()
     def _compute_sequence(self):
-        for rec in self:
-            if rec.barcode == False:
-                code = self.env.ref('matrix_product.product_sequence_matrix').code
-                rec.seq = self.env['ir.sequence'].next_by_code(code)
+        # computed once at creation: keep the number of an existing barcode and
+        # reserve one block of numbers for the rest of the batch; new records
+        # of a form view only get their number when they are saved
+        todo = self.filtered(lambda rec: rec.id and rec.barcode == False)
+        for rec in self - todo:
+            rec.seq = _barcode_sequence(rec.barcode)
+        for rec, number in zip(todo, todo._next_sequence_numbers()):
+            rec.seq = number
+
+    def _next_sequence_numbers(self):
+        """ Reserve a sequence number for each record of ``self`` and return
+            them in the order of ``self``. """
+        return self.env['matrix_product.productgroup']._next_sequence_numbers(
+            [rec.product_group.id for rec in self])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        vals_list = self._prepare_sequence_vals([dict(vals) for vals in vals_list])
+        return super(SequenceMixin, self).create(vals_list)
+
+    @api.model
+    def _sequence_group_id(self, vals):
+        """ Return the id of the product group of the creation values ``vals``. """
+        return vals.get('product_group')
 
+    @api.model
+    def _prepare_sequence_vals(self, vals_list):
+        """ Set the sequence number and the barcode in the creation values
+            without a barcode, reserving one block of numbers for those without
+            a number either, and return ``vals_list``. """
+        todo = [vals for vals in vals_list if not vals.get('barcode') and self._sequence_group_id(vals)]
+        if not todo:
+            return vals_list
+        Group = self.env['matrix_product.productgroup']
+        new = [vals for vals in todo if not vals.get('seq')]
+        for vals, number in zip(new, Group._next_sequence_numbers([self._sequence_group_id(vals) for vals in new])):
+            vals['seq'] = number
+        group_map = Group._get_group_map()
+        for vals in todo:
+            vals['barcode'] = group_map[self._sequence_group_id(vals)][0] + '.' + str(vals['seq'])
+        return vals_list
+
+    @api.model
+    def _backfill_sequence(self, batch_size=10000, auto_commit=False):
+        """ Fill ``seq`` on the records that predate the stored column, by
+            chunks of ``batch_size`` records. The number is taken from the
+            barcode when it has one, otherwise it is reserved in the sequence. """
+        self.flush()
+        self._cr.execute("SELECT id FROM %s WHERE seq IS NULL ORDER BY id" % self._table)
+        ids = [row[0] for row in self._cr.fetchall()]
+        for index in range(0, len(ids), batch_size):
+            records = self.with_context(active_test=False).browse(ids[index:index + batch_size])
+            numbers = {rec.id: _barcode_sequence(rec.barcode) for rec in records}
+            todo = self.browse([rec_id for rec_id, number in numbers.items() if not number])
+            numbers.update(zip(todo.ids, todo._next_sequence_numbers()))
+            self._cr.execute("""
+                UPDATE %s AS t SET seq = data.seq
+                FROM (SELECT unnest(%%s) AS id, unnest(%%s) AS seq) AS data
+                WHERE t.id = data.id
+            """ % self._table, (list(numbers), list(numbers.values())))
+            self.invalidate_cache()
+            if auto_commit:
+                self._cr.commit()
+            _logger.info('%s: sequence filled on %d/%d records',
+                         self._name, min(index + batch_size, len(ids)), len(ids))
+        return len(ids)
+
+
+class ProductTemplate(models.Model):
+    _name = 'product.template'
+    _inherit = ['product.template', 'matrix_product.sequence.mixin']
+
+    show_portal = fields.Boolean(string="Don't Show on Portal")
+    product_group = fields.Many2one('matrix_product.productgroup',
+        string='Product Group', required=True)
+
+    @api.model
+    def _prepare_sequence_vals(self, vals_list):
+        if self._context.get('create_product_product'):
+            # created along with a variant, which gives it its number, see
+            # Product.create()
+            for vals in vals_list:
+                vals.setdefault('seq', 0)
+            return vals_list
+        return super(ProductTemplate, self)._prepare_sequence_vals(vals_list)
 
     @api.onchange('product_group')
     def onchange_group(self):
+        group_map = self.env['matrix_product.productgroup']._get_group_map()
         for rec in self:
             if rec.product_group:
                 if rec.barcode:
-                    seq = rec.barcode.split('.')[1] 
-                else:
+                    seq = rec.barcode.split('.')[1]
+                elif rec.seq:
                     seq = str(rec.seq)
-                barcode = rec.product_group.code + '.' + seq
+                else:
+                    # not numbered yet, the barcode is set on creation
+                    continue
+                barcode = group_map[rec.product_group.id][0] + '.' + seq
                 rec.barcode = barcode
 
 class Product(models.Model):
-    _inherit = 'product.product'
+    _name = 'product.product'
+    _inherit = ['product.product', 'matrix_product.sequence.mixin']
 
-    seq = fields.Integer(
-        string='Sequence',
-        default=0,
-        stored=True,
-        compute='_compute_sequence'
-         )
-        
-    
-    @api.depends('barcode')
-    def _compute_sequence(self):
-        for rec in self:
-            if rec.barcode == False:
-                code = self.env.ref('matrix_product.product_sequence_matrix').code
-                rec.seq = self.env['ir.sequence'].next_by_code(code)
+    # on top of the exact unique(barcode) of product, the btree index of the
+    # exclusion constraint also serves the lookups of _check_barcodes_available()
+    _sql_constraints = [
+        ('barcode_normalized_uniq', 'EXCLUDE (upper(btrim(barcode)) WITH =)',
+         "A barcode can only be assigned to one product, regardless of case and spaces!"),
+    ]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        products = super(Product, self).create(vals_list)
+        # the templates created along with their variant share its number
+        for product in products:
+            if product.seq and not product.product_tmpl_id.seq:
+                product.product_tmpl_id.seq = product.seq
+        return products
+
+    @api.model
+    def _sequence_group_id(self, vals):
+        if vals.get('product_group') or not vals.get('product_tmpl_id'):
+            return super(Product, self)._sequence_group_id(vals)
+        return self.env['product.template'].browse(vals['product_tmpl_id']).product_group.id
+
+    @api.model
+    def _prepare_sequence_vals(self, vals_list):
+        # the first and only variant created for a template takes its number
+        Template = self.env['product.template']
+        counts = Counter(vals.get('product_tmpl_id') for vals in vals_list)
+        for vals in vals_list:
+            tmpl_id = vals.get('product_tmpl_id')
+            if not tmpl_id or counts[tmpl_id] > 1 or vals.get('barcode') or vals.get('seq'):
+                continue
+            template = Template.browse(tmpl_id)
+            if template.seq and not template.with_context(active_test=False).product_variant_ids:
+                vals['seq'] = template.seq
+        return super(Product, self)._prepare_sequence_vals(vals_list)
+
+    def _next_sequence_numbers(self):
+        # the only variant of a template shares the number of its template,
+        # both on creation and when filling the sequence of existing variants
+        single = self.filtered(lambda rec: rec.product_tmpl_id.seq
+                               and len(rec.product_tmpl_id.product_variant_ids) == 1)
+        numbers = dict(zip((self - single).ids, super(Product, self - single)._next_sequence_numbers()))
+        numbers.update((rec.id, rec.product_tmpl_id.seq) for rec in single)
+        return [numbers[rec.id] for rec in self]
 
     @api.onchange('product_group')
     def onchange_group(self):
+        group_map = self.env['matrix_product.productgroup']._get_group_map()
         for rec in self:
             if rec.product_group:
                 if rec.barcode:
-                    seq = rec.barcode.split('.')[1] 
-                else:
+                    seq = rec.barcode.split('.')[1]
+                elif rec.seq:
                     seq = str(rec.seq)
-                barcode = rec.product_group.code + '.' + seq
-                rec.barcode = barcode
\ No newline at end of file
+                else:
+                    # not numbered yet, the barcode is set on creation
+                    continue
+                barcode = group_map[rec.product_group.id][0] + '.' + seq
+                rec.barcode = barcode
+
+    def init(self):
+        super(Product, self).init()
+        self._cr.execute("CREATE SEQUENCE IF NOT EXISTS %s" % BARCODE_SIGNALING)
+
+    def write(self, vals):
+        # only barcodes of products are cached, setting the first barcode of a
+        # product, as done on creation, or the same one needs no invalidation
+        invalidate = any(
+            rec.barcode and any(fname in vals and vals[fname] != rec[fname] for fname in ('barcode', 'active'))
+            for rec in self)
+        res = super(Product, self).write(vals)
+        if invalidate:
+            self._invalidate_barcode_cache()
+        return res
+
+    def unlink(self):
+        invalidate = any(self.mapped('barcode'))
+        res = super(Product, self).unlink()
+        if invalidate:
+            self._invalidate_barcode_cache()
+        return res
+
+    @api.model
+    def _get_barcode_cache(self):
+        # dropped whenever the signaling sequence moves, so that a barcode
+        # change made in another worker is seen by this one
+        # the first nextval() only sets is_called, last_value stays at 1
+        self._cr.execute("SELECT last_value, is_called FROM %s" % BARCODE_SIGNALING)
+        signal = self._cr.fetchone()
+        dbname = self._cr.dbname
+        sequence, cache = _barcode_cache.get(dbname, (None, None))
+        if cache is None or sequence != signal:
+            cache = LRU(BARCODE_CACHE_SIZE)
+            _barcode_cache[dbname] = (signal, cache)
+        return cache
+
+    @api.model
+    def _invalidate_barcode_cache(self):
+        # only resolved barcodes are cached, creating products needs no invalidation
+        cr = self._cr
+        dbname = cr.dbname
+        _barcode_cache.pop(dbname, None)
+
+        def signal():
+            # the sequence is not transactional, move it once the change is
+            # visible to the other workers
+            _barcode_cache.pop(dbname, None)
+            cr.execute("SELECT nextval(%s)", [BARCODE_SIGNALING])
+
+        cr.after('commit', signal)
+        cr.after('rollback', lambda: _barcode_cache.pop(dbname, None))
+
+    @api.model
+    def resolve_barcode(self, barcode):
+        """ Return the id of the product with the given barcode, or False. """
+        return self.resolve_many([barcode])[barcode]
+
+    @api.model
+    def resolve_many(self, barcodes):
+        """ Map each of ``barcodes`` to the id of its product, or False.
+
+            Resolved barcodes are kept in a bounded per-worker cache, the others
+            are looked up at once. Barcodes in the ``<group code>.<seq>`` format
+            whose group code is unknown are not looked up at all. The lookup
+            ignores access rules, they apply when the products are read. """
+        cache = self._get_barcode_cache()
+        result = {}
+        missing = set()
+        for barcode in barcodes:
+            try:
+                result[barcode] = cache[barcode]
+            except KeyError:
+                missing.add(barcode)
+        if not missing:
+            return result
+
+        prefixes = {barcode.partition('.')[0] for barcode in missing if _barcode_sequence(barcode)}
+        if prefixes:
+            unknown = prefixes - set(self.env['matrix_product.productgroup']._get_group_code_map())
+            missing = {
+                barcode for barcode in missing
+                if not (_barcode_sequence(barcode) and barcode.partition('.')[0] in unknown)
+            }
+
+        found = {}
+        for sub_barcodes in split_every(self._cr.IN_MAX, missing):
+            for product in self.sudo().search_read([('barcode', 'in', list(sub_barcodes))], ['barcode']):
+                found[product['barcode']] = product['id']
+        for barcode, product_id in found.items():
+            cache[barcode] = product_id
+        for barcode in barcodes:
+            result.setdefault(barcode, found.get(barcode, False))
+        return result
+
+    @api.model
+    def _check_barcodes_available(self, barcodes, exclude_ids=()):
+        """ Raise a UserError if any of ``barcodes`` is repeated or already
+            used by a product other than ``exclude_ids``, with one query for
+            the whole batch. """
+        normalized = [barcode.strip().upper() for barcode in barcodes if barcode]
+        duplicates = {barcode for barcode, count in Counter(normalized).items() if count > 1}
+        self.flush(['barcode'])
+        self._cr.execute("""
+            SELECT upper(btrim(barcode)) FROM product_product
+             WHERE upper(btrim(barcode)) = ANY(%s) AND NOT id = ANY(%s)
+        """, (list(set(normalized)), list(exclude_ids)))
+        duplicates.update(row[0] for row in self._cr.fetchall())
+        if duplicates:
+            raise UserError(_("The following barcodes are already used: %s") % ', '.join(sorted(duplicates)[:20]))
+
+    @api.model
+    def _find_duplicate_barcodes(self):
+        """ Return the groups of variants whose barcodes collide, either once
+            normalized or by having the same number in the same product group,
+            as a list of ``(key, product ids)``. """
+        self.flush(['barcode', 'product_tmpl_id'])
+        self.env['product.template'].flush(['product_group'])
+        self._cr.execute("""
+            SELECT upper(btrim(pp.barcode)), pt.product_group, split_part(pp.barcode, '.', 2),
+                   array_agg(pp.id ORDER BY pp.id)
+              FROM product_product pp
+              JOIN product_template pt ON pt.id = pp.product_tmpl_id
+             WHERE pp.barcode IS NOT NULL AND pp.barcode != ''
+          GROUP BY GROUPING SETS ((upper(btrim(pp.barcode))),
+                                  (pt.product_group, split_part(pp.barcode, '.', 2)))
+            HAVING count(*) > 1
+        """)
+        group_map = self.env['matrix_product.productgroup']._get_group_map()
+        result = []
+        for barcode, group_id, number, product_ids in self._cr.fetchall():
+            if barcode is None:
+                if not group_id or not number:
+                    continue
+                barcode = '%s.%s' % (group_map[group_id][0], number)
+            result.append((barcode, product_ids))
+        return result
+
+    @api.model
+    def action_find_duplicate_barcodes(self):
+        product_ids = {pid for key, ids in self._find_duplicate_barcodes() for pid in ids}
+        return {
+            'name': _('Duplicate Barcodes'),
+            'type': 'ir.actions.act_window',
+            'res_model': 'product.product',
+            'view_mode': 'tree,form',
+            'domain': [('id', 'in', list(product_ids))],
+            'context': {'active_test': False},
+        }
+
+    @api.model
+    def _export_catalog(self, label_columns=0, itersize=2000):
+        """ Yield the active variants as CSV lines with their barcode, group
+            code and name, sequence number, internal reference and name.
+
+            With ``label_columns``, each line holds that many labels side by
+            side, for label sheets. Rows are read through a server-side cursor
+            by batches of ``itersize``, so memory does not depend on the size
+            of the catalog. Only the variants readable through the record
+            rules of variants and templates are exported. """
+        Template = self.env['product.template']
+        self.check_access_rights('read')
+        Template.check_access_rights('read')
+        self.flush(['barcode', 'seq', 'default_code', 'active', 'product_tmpl_id'])
+        Template.flush(['name', 'product_group'])
+        query = self._where_calc([('active', '=', True)])
+        self._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        template_query = Template._where_calc([])
+        Template._apply_ir_rules(template_query, 'read')
+        template_from, template_where, template_params = template_query.get_sql()
+        group_map = self.env['matrix_product.productgroup']._get_group_map()
+        fnames = ['barcode', 'group_code', 'group_name', 'seq', 'default_code', 'name']
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def line(values):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            return buffer.getvalue()
+
+        yield line(fnames * (label_columns or 1))
+        labels = []
+        with self._cr._cnx.cursor('matrix_product_export') as cursor:
+            cursor.itersize = itersize
+            cursor.execute("""
+                SELECT "product_product".barcode, pt.product_group, "product_product".seq,
+                       "product_product".default_code, pt.name
+                  FROM {}, product_template pt
+                 WHERE pt.id = "product_product".product_tmpl_id
+                   AND {}
+                   AND pt.id IN (SELECT "product_template".id FROM {} WHERE {})
+              ORDER BY "product_product".id
+            """.format(from_clause, where_clause or 'TRUE', template_from, template_where or 'TRUE'),
+                where_params + template_params)
+            for barcode, group_id, seq, default_code, name in cursor:
+                code, group_name = group_map[group_id][:2] if group_id else ('', '')
+                values = [barcode or '', code, group_name, seq or '', default_code or '', name]
+                if not label_columns:
+                    yield line(values)
+                    continue
+                labels.extend(values)
+                if len(labels) == len(fnames) * label_columns:
+                    yield line(labels)
+                    labels = []
+        if labels:
+            yield line(labels)
\ No newline at end of file
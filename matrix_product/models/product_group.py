@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from odoo import api, models, fields, _
+import logging
+from collections import defaultdict
+
+from odoo import api, models, fields, tools, _
+
+_logger = logging.getLogger(__name__)
 
 class ProductGroup(models.Model):
     _name = "matrix_product.productgroup"
@@ -17,5 +22,142 @@ class ProductGroup(models.Model):
         help='Two digit code'
     )
     seq = fields.Integer(string="Sequence number")
+    sequence_id = fields.Many2one('ir.sequence',
+        string='Barcode Sequence', readonly=True, copy=False,
+        help='Sequence numbering the products of this group, created on first use '
+             'when the system parameter matrix_product.sequence_per_group is set')
+
+    @api.model
+    def _sequence_per_group(self):
+        """ Whether every product group numbers its products from its own sequence. """
+        return bool(self.env['ir.config_parameter'].sudo().get_param('matrix_product.sequence_per_group'))
+
+    @api.model
+    def _next_sequence_numbers(self, group_ids):
+        """ Reserve a product sequence number for each of ``group_ids`` (ids of
+            product groups, repeated as needed), with one block per sequence,
+            and return them in the same order. """
+        per_group = self._sequence_per_group()
+        batches = defaultdict(list)
+        for index, group_id in enumerate(group_ids):
+            batches[group_id if per_group else False].append(index)
+        numbers = [0] * len(group_ids)
+        for group_id, indexes in batches.items():
+            sequence = self.browse(group_id)._get_sequence()
+            for index, number in zip(indexes, sequence._next_block(len(indexes))):
+                numbers[index] = int(number)
+        return numbers
+
+    def _get_sequence(self):
+        """ Return the sequence of this group, created from the global product
+            sequence on first use. The global sequence is returned for an empty
+            recordset. """
+        default = self.env.ref('matrix_product.product_sequence_matrix').sudo()
+        if not self:
+            return default
+        self.ensure_one()
+        group = self.sudo()
+        if not group.sequence_id:
+            # lock the group, so that concurrent workers create one sequence
+            self._cr.execute("SELECT sequence_id FROM matrix_product_productgroup WHERE id = %s FOR UPDATE",
+                             (group.id,))
+            group.invalidate_cache(['sequence_id'], group.ids)
+        if not group.sequence_id:
+            # the products of the group may have been numbered from the global
+            # sequence, start after the highest number of the group
+            self.env['product.template'].flush(['seq', 'product_group'])
+            self.env['product.product'].flush(['seq', 'product_tmpl_id'])
+            self._cr.execute("""
+                SELECT max(seq) FROM (
+                    SELECT seq FROM product_template WHERE product_group = %s
+                     UNION ALL
+                    SELECT pp.seq FROM product_product pp
+                      JOIN product_template pt ON pt.id = pp.product_tmpl_id
+                     WHERE pt.product_group = %s
+                ) AS numbers
+            """, (group.id, group.id))
+            group.sequence_id = default.copy({
+                'name': '%s: %s' % (default.name, group.name),
+                'code': False,
+                'number_next': default._sequence_counter(self._cr.fetchone()[0]) + 1,
+            })
+        return group.sequence_id
+
+    @api.model
+    @tools.ormcache()
+    def _get_group_map(self):
+        """ Return ``{group id: (code, name, seq)}`` for all product groups.
+            The result is cached and shared, do not modify it. """
+        return {
+            group['id']: (group['code'], group['name'], group['seq'])
+            for group in self.sudo().search_read([], ['code', 'name', 'seq'])
+        }
+
+    @api.model
+    @tools.ormcache()
+    def _get_group_code_map(self):
+        """ Return ``{code: group id}`` for all product groups. """
+        return {code: group_id for group_id, (code, name, seq) in self._get_group_map().items()}
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        groups = super(ProductGroup, self).create(vals_list)
+        self.clear_caches()
+        return groups
+
+    def write(self, vals):
+        old_codes = {group.id: group.code for group in self} if 'code' in vals else {}
+        res = super(ProductGroup, self).write(vals)
+        if any(fname in vals for fname in ('code', 'name', 'seq')):
+            self.clear_caches()
+        for group in self:
+            if group.id in old_codes and old_codes[group.id] != group.code:
+                group._regenerate_barcodes(old_codes[group.id])
+        return res
+
+    def unlink(self):
+        res = super(ProductGroup, self).unlink()
+        self.clear_caches()
+        return res
 
-    
\ No newline at end of file
+    def _regenerate_barcodes(self, old_code, batch_size=10000, auto_commit=False):
+        """ Replace the ``old_code`` prefix of the barcodes of the products of
+            this group by its current code, with one UPDATE per chunk of
+            ``batch_size`` variants. Barcodes that were not built from the
+            group code are left untouched. Return the number of variants updated. """
+        self.ensure_one()
+        cr = self._cr
+        Product = self.env['product.product']
+        Product.flush(['barcode', 'product_tmpl_id'])
+        self.env['product.template'].flush(['product_group'])
+        prefix = old_code + '.'
+        cr.execute("""
+            SELECT pp.id, pp.barcode
+              FROM product_product pp
+              JOIN product_template pt ON pt.id = pp.product_tmpl_id
+             WHERE pt.product_group = %s
+               AND left(pp.barcode, %s) = %s
+          ORDER BY pp.id
+        """, (self.id, len(prefix), prefix))
+        rows = cr.fetchall()
+        ids = [row[0] for row in rows]
+        # validate all the new barcodes before updating any of them
+        Product._check_barcodes_available(
+            [self.code + '.' + barcode[len(prefix):] for product_id, barcode in rows], exclude_ids=ids)
+        for index in range(0, len(ids), batch_size):
+            cr.execute("""
+                UPDATE product_product
+                   SET barcode = %s || substr(barcode, %s),
+                       write_uid = %s,
+                       write_date = (now() at time zone 'UTC')
+                 WHERE id = ANY(%s)
+            """, (self.code + '.', len(prefix) + 1, self.env.uid, ids[index:index + batch_size]))
+            if auto_commit:
+                cr.commit()
+            _logger.info('Product group %s: %d/%d barcodes regenerated from %r to %r',
+                         self.id, min(index + batch_size, len(ids)), len(ids), old_code, self.code)
+        Product.invalidate_cache(['barcode', 'write_uid', 'write_date'], ids)
+        self.env['product.template'].invalidate_cache(['barcode'])
+        if ids:
+            Product._invalidate_barcode_cache()
+        return len(ids)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import logging
+import multiprocessing
+from collections import deque
+
+from werkzeug.local import release_local
+
+import odoo
+from odoo import api, http, models, _
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+# worker state, see _init_worker()
+_worker = {}
+
+
+def _init_worker(dbname):
+    # The connections of the parent process are inherited through fork(): keep
+    # them referenced so that they are never closed from here, and open new
+    # ones. Pool workers leave with os._exit(), without garbage collection.
+    _worker['inherited_pool'] = odoo.sql_db._Pool
+    odoo.sql_db._Pool = None
+    _worker['connection'] = odoo.sql_db.db_connect(dbname)
+    # drop the environments of the parent inherited with the thread locals,
+    # every chunk gets its own, see _import_chunk()
+    release_local(api.Environment._local)
+
+
+def _import_chunk(uid, context, vals_list):
+    # the environments and their cache are released after each chunk, the
+    # cursor commits when leaving the block
+    with api.Environment.manage(), _worker['connection'].cursor() as cr:
+        env = api.Environment(cr, uid, context)
+        env['product.template'].create(vals_list)
+    return len(vals_list)
+
+
+class ProductImport(models.AbstractModel):
+    _name = 'matrix_product.product.import'
+    _description = 'Product Catalog Import'
+
+    @api.model
+    def import_csv(self, path, processes=4, chunk_size=1000, delimiter=','):
+        """ Create the product templates of the CSV file at ``path``.
+
+            The file has a ``name`` and a ``group_code`` column, other columns
+            are product.template field names whose values are passed to create
+            as they are (empty cells become False). The file is streamed by
+            chunks of ``chunk_size`` rows: group codes are resolved and sequence
+            numbers reserved here, then each chunk is created and committed by
+            one of ``processes`` forked workers with its own cursor.
+
+            Workers only see committed data, product groups must exist
+            beforehand. Chunks committed before an error stay committed. Rows
+            with an unknown group code are skipped.
+
+            The workers are forked from the calling process: run the import
+            from ``odoo shell`` or a scheduled action, not from a request.
+
+            :return: dict with the number of ``created`` products and the
+                     ``skipped`` row numbers
+        """
+        if http.request:
+            raise UserError(_("The product import forks worker processes, run it from "
+                              "the Odoo shell or a scheduled action."))
+        Template = self.env['product.template']
+        Product = self.env['product.product']
+        Group = self.env['matrix_product.productgroup']
+        group_ids = Group._get_group_code_map()
+        group_map = Group._get_group_map()
+        context = dict(self.env.context, tracking_disable=True, mail_create_nolog=True)
+        created = 0
+        skipped = []
+        with open(path, newline='') as csv_file:
+            reader = csv.DictReader(csv_file, delimiter=delimiter)
+            columns = set(reader.fieldnames or ())
+            if not {'name', 'group_code'} <= columns:
+                raise UserError(_("The file must have a 'name' and a 'group_code' column."))
+            unknown = columns - {'group_code'} - set(Template._fields)
+            if unknown:
+                raise UserError(_("Unknown product fields: %s") % ', '.join(sorted(unknown)))
+
+            pool = multiprocessing.get_context('fork').Pool(
+                processes, initializer=_init_worker, initargs=(self._cr.dbname,))
+            pending = deque()
+
+            def collect():
+                count = pending.popleft().get()
+                _logger.info('Product import %s: %d products created', path, created + count)
+                return count
+
+            try:
+                for rows in split_every(chunk_size, enumerate(reader, start=2)):
+                    vals_list = []
+                    for line, row in rows:
+                        group_id = group_ids.get(row.pop('group_code'))
+                        if not group_id:
+                            skipped.append(line)
+                            continue
+                        vals = {fname: value or False for fname, value in row.items()}
+                        vals['product_group'] = group_id
+                        vals_list.append(vals)
+                    if not vals_list:
+                        continue
+                    numbers = Group._next_sequence_numbers([vals['product_group'] for vals in vals_list])
+                    for vals, number in zip(vals_list, numbers):
+                        vals['seq'] = number
+                    # the barcodes are built from the numbers on creation, see
+                    # _prepare_sequence_vals()
+                    Product._check_barcodes_available([
+                        group_map[vals['product_group']][0] + '.' + str(vals['seq']) for vals in vals_list])
+                    # bound the number of chunks held in memory
+                    if len(pending) >= processes * 2:
+                        created += collect()
+                    pending.append(pool.apply_async(_import_chunk, (self.env.uid, context, vals_list)))
+                while pending:
+                    created += collect()
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        if skipped:
+            _logger.warning('Product import %s: %d rows with an unknown group code skipped', path, len(skipped))
+        return {'created': created, 'skipped': skipped}
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+class SaleOrder(models.Model):
+    _inherit = 'sale.order'
+
+    def _get_portal_lines(self):
+        """ Return the lines to display on the portal, i.e. without the lines
+            of products hidden from the portal, as a list of dicts with keys:
+
+            - ``line``: the sale.order.line
+            - ``section_end``: whether the section subtotal follows the line
+            - ``subtotal``, ``total``: the section subtotal, tax excluded and
+              tax included, when ``section_end`` is set
+        """
+        self.ensure_one()
+        # prefetches the products of all lines at once
+        lines = self.order_line.filtered(lambda line: not line.product_id.show_portal)
+        result = []
+        section = False
+        subtotal = total = 0.0
+        for line in lines:
+            if line.display_type == 'line_section':
+                if section:
+                    result[-1].update(section_end=True, subtotal=subtotal, total=total)
+                section = line
+                subtotal = total = 0.0
+            else:
+                subtotal += line.price_subtotal
+                total += line.price_total
+            result.append({'line': line, 'section_end': False, 'subtotal': 0.0, 'total': 0.0})
+        if section:
+            result[-1].update(section_end=True, subtotal=subtotal, total=total)
+        return result
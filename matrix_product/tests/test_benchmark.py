@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from odoo import release
+from odoo.tests import common, tagged
+
+_logger = logging.getLogger(__name__)
+
+# comma separated record counts, e.g. MATRIX_PRODUCT_BENCH_SCALES=1000,10000,100000
+SCALES = [int(scale) for scale in os.environ.get('MATRIX_PRODUCT_BENCH_SCALES', '1000').split(',')]
+# path of the JSON file receiving the results, they are logged otherwise
+OUTPUT = os.environ.get('MATRIX_PRODUCT_BENCH_OUTPUT')
+
+
+@tagged('-standard', 'post_install', '-at_install', 'matrix_product_benchmark')
+class TestCatalogBenchmark(common.SavepointCase):
+    """ Timings of the catalog operations of this module. Not part of the
+        standard tests, run them against a local database with::
+
+            odoo-bin -d <db> --test-tags matrix_product_benchmark --stop-after-init
+
+        Created records are rolled back, but sequence numbers are consumed. """
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCatalogBenchmark, cls).setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.results = []
+        cls.partner = cls.env['res.partner'].create({'name': 'Benchmark Customer'})
+
+    @classmethod
+    def tearDownClass(cls):
+        output = json.dumps({
+            'version': release.version,
+            'results': cls.results,
+        }, indent=2)
+        if OUTPUT:
+            with open(OUTPUT, 'w') as f:
+                f.write(output)
+        _logger.info('matrix_product benchmark results:\n%s', output)
+        super(TestCatalogBenchmark, cls).tearDownClass()
+
+    @contextmanager
+    def measure(self, operation, scale):
+        self.env['base'].flush()
+        self.env['base'].invalidate_cache()
+        queries = self.cr.sql_log_count
+        start = time.time()
+        yield
+        self.env['base'].flush()
+        self.results.append({
+            'operation': operation,
+            'scale': scale,
+            'seconds': round(time.time() - start, 4),
+            'queries': self.cr.sql_log_count - queries,
+        })
+
+    def _create_group(self, scale):
+        return self.env['matrix_product.productgroup'].create({
+            'name': 'Benchmark %d' % scale,
+            'code': 'B%d' % len(self.results),
+        })
+
+    def _create_products(self, group, scale, **values):
+        return self.env['product.product'].create([
+            dict(values, name='Benchmark %d' % index, product_group=group.id)
+            for index in range(scale)
+        ])
+
+    def test_01_create_products(self):
+        for scale in SCALES:
+            group = self._create_group(scale)
+            with self.measure('create_products', scale):
+                products = self._create_products(group, scale)
+            self.assertEqual(len(products), scale)
+            self.assertTrue(all(products.mapped('seq')))
+
+    def test_02_regenerate_barcodes(self):
+        for scale in SCALES:
+            group = self._create_group(scale)
+            products = self._create_products(group, scale)
+            with self.measure('regenerate_barcodes', scale):
+                group.write({'code': group.code + 'R'})
+            self.assertTrue(products[0].barcode.startswith(group.code + '.'))
+
+    def test_03_barcode_lookup(self):
+        for scale in SCALES:
+            group = self._create_group(scale)
+            barcodes = self._create_products(group, scale).mapped('barcode')
+            with self.measure('barcode_search', scale):
+                for barcode in barcodes:
+                    self.env['product.product'].search([('barcode', '=', barcode)], limit=1)
+            self.env['product.product']._invalidate_barcode_cache()
+            with self.measure('barcode_resolve_many_cold', scale):
+                resolved = self.env['product.product'].resolve_many(barcodes)
+            with self.measure('barcode_resolve_many_warm', scale):
+                self.env['product.product'].resolve_many(barcodes)
+            self.assertTrue(all(resolved.values()))
+
+    def test_04_portal_rendering(self):
+        for scale in SCALES:
+            group = self._create_group(scale)
+            visible = self._create_products(group, scale // 2 or 1)
+            hidden = self._create_products(group, scale // 2 or 1, show_portal=True)
+            lines = [(0, 0, {'display_type': 'line_section', 'name': 'Section'})]
+            for index, product in enumerate(visible | hidden):
+                if index % 50 == 49:
+                    lines.append((0, 0, {'display_type': 'line_section', 'name': 'Section %d' % index}))
+                lines.append((0, 0, {'product_id': product.id, 'product_uom_qty': 1, 'price_unit': 10.0}))
+            order = self.env['sale.order'].create({'partner_id': self.partner.id, 'order_line': lines})
+            with self.measure('portal_lines', scale):
+                portal_lines = order._get_portal_lines()
+            with self.measure('portal_rendering', scale):
+                self.env['ir.qweb'].render('sale.sale_order_portal_content', {
+                    'sale_order': order,
+                    'report_type': 'html',
+                })
+            self.assertEqual(
+                len([data for data in portal_lines if not data['line'].display_type]), len(visible))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import common
+
+from ..models.product import BARCODE_SIGNALING
+
+
+class TestProductBarcode(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestProductBarcode, cls).setUpClass()
+        cls.Product = cls.env['product.product']
+        cls.product = cls.Product.create({'name': 'Barcode Test', 'barcode': 'MATRIX-TEST-A'})
+
+    def test_resolve_many(self):
+        self.assertEqual(self.Product.resolve_many(['MATRIX-TEST-A', 'MATRIX-TEST-X']),
+                         {'MATRIX-TEST-A': self.product.id, 'MATRIX-TEST-X': False})
+        self.assertEqual(self.Product._get_barcode_cache()['MATRIX-TEST-A'], self.product.id)
+        # a barcode change is seen at once by this worker
+        self.product.barcode = 'MATRIX-TEST-B'
+        self.assertEqual(self.Product.resolve_many(['MATRIX-TEST-A', 'MATRIX-TEST-B']),
+                         {'MATRIX-TEST-A': False, 'MATRIX-TEST-B': self.product.id})
+
+    def test_barcode_cache_signal(self):
+        self.Product.resolve_barcode('MATRIX-TEST-A')
+        cache = self.Product._get_barcode_cache()
+        self.assertIs(self.Product._get_barcode_cache(), cache)
+        # another worker committed a barcode change, from a new sequence on
+        self.cr.execute("SELECT setval(%s, 1, false)", [BARCODE_SIGNALING])
+        cache = self.Product._get_barcode_cache()
+        self.cr.execute("SELECT nextval(%s)", [BARCODE_SIGNALING])
+        self.assertIsNot(self.Product._get_barcode_cache(), cache)
+
+
+class TestProductSequence(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestProductSequence, cls).setUpClass()
+        cls.group = cls.env['matrix_product.productgroup'].create({'name': 'Sequence Test', 'code': 'ST'})
+
+    def test_create_variant(self):
+        # created without template, the template takes the number of the variant
+        first, second = self.env['product.product'].create([
+            {'name': 'Variant 1', 'product_group': self.group.id},
+            {'name': 'Variant 2', 'product_group': self.group.id},
+        ])
+        self.assertTrue(first.seq)
+        self.assertEqual(first.product_tmpl_id.seq, first.seq)
+        self.assertEqual(first.barcode, 'ST.%d' % first.seq)
+        # one number per product
+        self.assertEqual(second.seq, first.seq + 1)
+        self.assertEqual(second.product_tmpl_id.seq, second.seq)
+
+    def test_create_template(self):
+        template = self.env['product.template'].create({'name': 'Template', 'product_group': self.group.id})
+        self.assertTrue(template.seq)
+        self.assertEqual(template.product_variant_ids.seq, template.seq)
@@ -8,19 +8,163 @@
 import base64
 import datetime
 import logging
+import mmap
+import os
 import psycopg2
+import queue
 import smtplib
 import threading
+import time
 import re
+import uuid
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+from email.mime.base import MIMEBase
 from email.utils import formataddr
-from odoo.addons.base.models.ir_mail_server import MailDeliveryException
+from odoo.addons.base.models.ir_mail_server import MailDeliveryException, encode_header_param, extract_rfc2822_addresses
 from odoo.exceptions import UserError
 from odoo import _, api, fields, models, SUPERUSER_ID, tools
+from odoo.osv import expression
+from odoo.tools.lru import LRU
 from odoo.tools.safe_eval import safe_eval
 
 _logger = logging.getLogger(__name__)
 
+# maximum size of the decoded attachments kept during a mail.mail _send() batch
+ATTACHMENT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# filestore attachments from this size on are encoded straight from their file
+ATTACHMENT_STREAM_MIN_SIZE = 4 * 1024 * 1024
+# bytes encoded at a time, a multiple of the 57 bytes of a 76 characters base64 line
+ATTACHMENT_STREAM_CHUNK_SIZE = 57 * 1024
+
+
+def _attachment_mime_part(path, name, mimetype):
+    """ Return a base64 MIME part for the file at ``path``, encoded by chunks
+        from a memory map, so that the decoded content of the file is never
+        loaded next to its encoded form. The encoded chunks are joined into
+        the payload, which the email library requires as one string: the
+        peak is about twice the encoded size. The headers are the ones of
+        ir.mail_server.build_email(). """
+    filename_rfc2047 = encode_header_param(name)
+    if mimetype and '/' in mimetype:
+        maintype, subtype = mimetype.split('/', 1)
+        part = MIMEBase(maintype, subtype)
+    else:
+        part = MIMEBase('application', 'octet-stream')
+    # RFC2047 filename, as the default RFC2231 encoding does not work in GMail
+    part.set_param('name', filename_rfc2047)
+    chunks = []
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset in range(0, len(data), ATTACHMENT_STREAM_CHUNK_SIZE):
+                    chunks.append(base64.encodebytes(data[offset:offset + ATTACHMENT_STREAM_CHUNK_SIZE]).decode('ascii'))
+    part.set_payload(''.join(chunks))
+    del chunks
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=filename_rfc2047)
+    return part
+
+
+class AttachmentCache(object):
+    """ Decoded attachment payloads and encoded MIME parts shared by the mails
+        of a _send() batch, keyed by attachment id and checksum. The least
+        recently used entries are evicted once their total size exceeds
+        ``max_size`` bytes. """
+
+    def __init__(self, max_size=ATTACHMENT_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._payloads = OrderedDict()
+
+    def get(self, key):
+        entry = self._payloads.get(key)
+        if entry is None:
+            return None
+        self._payloads.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, payload, size=None):
+        """ Cache ``payload``, a ``(name, content, mimetype)`` tuple, or an
+            object of the given ``size``. """
+        if size is None:
+            size = len(payload[1])
+        if size > self.max_size:
+            return
+        self._payloads[key] = (payload, size)
+        self.size += size
+        while self.size > self.max_size:
+            key, (payload, size) = self._payloads.popitem(last=False)
+            self.size -= size
+
+
+# per-worker (model, res_id) -> root message id of flat threads, by database,
+# see Message._get_thread_root_id()
+THREAD_ROOT_CACHE_SIZE = 8192
+_thread_root_cache = {}
+# postgres sequence moved when a root may have changed, see
+# Message._invalidate_thread_root_cache()
+THREAD_ROOT_SIGNALING = 'mail_thread_root_signaling'
+
+
+class SmtpPool(object):
+    """ Delivers messages from ``size`` threads, each one using its own SMTP
+        connection opened with ``connect(**connect_params)``. Only the SMTP
+        exchange happens in the threads, they never use the database, and a
+        connection dropped by the server is reopened once per message. At most
+        twice ``size`` messages wait for delivery at a time. """
+
+    def __init__(self, connect, connect_params, size):
+        self.connect = connect
+        self.connect_params = connect_params
+        self.sessions = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size * 2)
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+    def submit(self, smtp_from, smtp_to_list, message):
+        """ Deliver ``message`` to the envelope ``smtp_from``/``smtp_to_list``
+            and return a future of its Message-Id and the addresses refused by
+            the server, see smtplib.SMTP.sendmail(). """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._deliver, smtp_from, smtp_to_list, message)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    def _deliver(self, smtp_from, smtp_to_list, message):
+        try:
+            smtp = self.sessions.get_nowait()
+        except queue.Empty:
+            smtp = self.connect(**self.connect_params)
+        try:
+            try:
+                refused = smtp.sendmail(smtp_from, smtp_to_list, message.as_string())
+            except smtplib.SMTPServerDisconnected:
+                self._quit(smtp)
+                smtp = self.connect(**self.connect_params)
+                refused = smtp.sendmail(smtp_from, smtp_to_list, message.as_string())
+        except Exception:
+            # the session may be in any state, do not reuse it
+            self._quit(smtp)
+            raise
+        self.sessions.put(smtp)
+        return message['Message-Id'], set(refused)
+
+    def _quit(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.sessions.empty():
+            self._quit(self.sessions.get_nowait())
+
 
 class ResCompany(models.Model):
 
@@ -102,6 +246,24 @@ class MailComposer(models.TransientModel):
     reply_to = fields.Char(
         'Reply-To', default=get_default_reply_to,
         help='Reply email address. Setting the reply_to bypasses the automatic thread creation.')
+    last_res_id = fields.Integer(
+        'Last Processed Record', readonly=True, copy=False,
+        help='Id of the last record processed with the active domain, sending resumes after it.')
+
+    def _iter_active_domain_res_ids(self, batch_size):
+        """ Yield the ids of the records matching the active domain by batches
+            of ``batch_size``, in id order, from the one after ``last_res_id``.
+            Only one batch of ids is held at a time, the caller moves
+            ``last_res_id`` forward and commits once it has processed a batch. """
+        self.ensure_one()
+        Model = self.env[self.model]
+        domain = safe_eval(self.active_domain)
+        while True:
+            res_ids = Model.search(
+                expression.AND([domain, [('id', '>', self.last_res_id)]]), order='id', limit=batch_size).ids
+            if not res_ids:
+                return
+            yield res_ids
 
     def get_mail_values(self, res_ids):
         """Generate the values that will be used by send_mail to create mail_messages
@@ -175,16 +337,22 @@ class MailComposer(models.TransientModel):
                 # do not send emails directly but use the queue instead
                 # add context key to avoid subscribing the author
                 ActiveModel = ActiveModel.with_context(mail_notify_force_send=False, mail_create_nosubscribe=True)
+            batch_size = int(self.env['ir.config_parameter'].sudo().get_param('mail.batch_size')) or self._batch_size
             # wizard works in batch mode: [res_id] or active_ids or active_domain
-            if mass_mode and wizard.use_active_domain and wizard.model:
-                res_ids = self.env[wizard.model].search(safe_eval(wizard.active_domain)).ids
-            elif mass_mode and wizard.model and self._context.get('active_ids'):
-                res_ids = self._context['active_ids']
+            streaming = mass_mode and wizard.use_active_domain and wizard.model
+            # a streamed run commits each batch with its progress, also when
+            # sent from the UI without auto_commit: a failure then resumes
+            # after the last batch instead of rolling back the whole run
+            commit_batches = streaming and (
+                auto_commit is True or not getattr(threading.currentThread(), 'testing', False))
+            if streaming:
+                sliced_res_ids = wizard._iter_active_domain_res_ids(batch_size)
             else:
-                res_ids = [wizard.res_id]
-
-            batch_size = int(self.env['ir.config_parameter'].sudo().get_param('mail.batch_size')) or self._batch_size
-            sliced_res_ids = [res_ids[i:i + batch_size] for i in range(0, len(res_ids), batch_size)]
+                if mass_mode and wizard.model and self._context.get('active_ids'):
+                    res_ids = self._context['active_ids']
+                else:
+                    res_ids = [wizard.res_id]
+                sliced_res_ids = [res_ids[i:i + batch_size] for i in range(0, len(res_ids), batch_size)]
 
             if wizard.composition_mode == 'mass_mail' or wizard.is_log or (wizard.composition_mode == 'mass_post' and not wizard.notify):  # log a note: subtype is False
                 subtype_id = False
@@ -195,6 +363,8 @@ class MailComposer(models.TransientModel):
 
             for res_ids in sliced_res_ids:
                 batch_mails = Mail
+                # values of the mails of the posted messages, created at once
+                to_mail_values = []
                 all_mail_values = wizard.get_mail_values(res_ids)
                 for res_id, mail_values in all_mail_values.items():
                     if wizard.composition_mode == 'mass_mail':
@@ -220,16 +390,31 @@ class MailComposer(models.TransientModel):
                         else:
                             ActiveModel.browse(res_id).message_post(**post_params)
 
-                            to_mail = Mail.create(mail_values)
+                            to_mail_values.append(dict(mail_values))
                             if mail_values.get('cc_recipient_ids'):
-                                to_mail.cc_recipient_ids = [(6, 0, mail_values.get('cc_recipient_ids').ids)]
-                                to_mail.res_id = False
-                            to_mail.send(auto_commit=auto_commit)
+                                to_mail_values[-1].update(
+                                    cc_recipient_ids=[(6, 0, mail_values['cc_recipient_ids'].ids)],
+                                    res_id=False)
 
+                if to_mail_values:
+                    to_mails = Mail.create(to_mail_values)
+                    # in mass mode, delivered by the mail queue like the
+                    # notifications of the posted messages
+                    if not mass_mode:
+                        to_mails.send(auto_commit=auto_commit)
 
                 if wizard.composition_mode == 'mass_mail':
                     batch_mails.send(auto_commit=auto_commit)
 
+                if streaming:
+                    # keep the progress with the batch, and release the batch
+                    # before fetching the next one
+                    wizard.last_res_id = res_ids[-1]
+                    self.env['base'].flush()
+                    if commit_batches:
+                        self._cr.commit()
+                    self.invalidate_cache()
+
 
 class Message(models.Model):
     """ Messages model: system notification (replacing res.log notifications),
@@ -251,20 +436,22 @@ class Message(models.Model):
 
     def message_format(self):
         res = super(Message, self).message_format()
-        partners_dict = {}
+        # read the cc/bcc partner names of all messages at once
+        partner_ids = set()
+        for obj in res:
+            partner_ids.update(obj.get('cc_recipient_ids', []))
+            partner_ids.update(obj.get('bcc_recipient_ids', []))
+        partners_dict = {
+            partner['id']: partner['name']
+            for partner in self.env['res.partner'].browse(list(partner_ids)).read(['name'])
+        }
         for obj in res:
-            cc_partners = ''
-            bcc_partners = ''
-            cc_partners_list = self.env['res.partner'].browse(
-                obj.get('cc_recipient_ids', [])).read(['name'])
-            for item in cc_partners_list:
-                cc_partners += item.get('name') + ', '
-            bcc_partners_list = self.env['res.partner'].browse(
-                obj.get('bcc_recipient_ids', [])).read(['name'])
-            for item in bcc_partners_list:
-                bcc_partners += item.get('name') + ', '
-            obj['cc_partners'] = cc_partners
-            obj['bcc_partners'] = bcc_partners
+            obj['cc_partners'] = ''.join(
+                '%s, ' % partners_dict[pid]
+                for pid in obj.get('cc_recipient_ids', []) if pid in partners_dict)
+            obj['bcc_partners'] = ''.join(
+                '%s, ' % partners_dict[pid]
+                for pid in obj.get('bcc_recipient_ids', []) if pid in partners_dict)
         return res
 
     def _get_message_format_fields(self):
@@ -274,175 +461,694 @@ class Message(models.Model):
             'email_bcc', 'bcc_recipient_ids',
         ]
 
+    def init(self):
+        super(Message, self).init()
+        self._cr.execute("CREATE SEQUENCE IF NOT EXISTS %s" % THREAD_ROOT_SIGNALING)
+
+    def write(self, vals):
+        if any(fname in vals for fname in ('model', 'res_id', 'message_type')):
+            # messages moved to another thread may become its root
+            self._invalidate_thread_root_cache()
+        return super(Message, self).write(vals)
+
+    def unlink(self):
+        # any deleted thread message may be the root of its thread: signal
+        # without looking it up, the other workers search their roots again
+        if any(message.model and message.res_id and message.message_type != 'user_notification'
+               for message in self):
+            self._invalidate_thread_root_cache()
+        return super(Message, self).unlink()
+
+    @api.model
+    def _get_thread_root_cache(self):
+        # dropped whenever the signaling sequence moves, so that a root
+        # deleted in another worker is not used by this one
+        # the first nextval() only sets is_called, last_value stays at 1
+        self._cr.execute("SELECT last_value, is_called FROM %s" % THREAD_ROOT_SIGNALING)
+        signal = self._cr.fetchone()
+        dbname = self._cr.dbname
+        sequence, cache = _thread_root_cache.get(dbname, (None, None))
+        if cache is None or sequence != signal:
+            cache = LRU(THREAD_ROOT_CACHE_SIZE)
+            _thread_root_cache[dbname] = (signal, cache)
+        return cache
+
+    @api.model
+    def _invalidate_thread_root_cache(self):
+        cr = self._cr
+        dbname = cr.dbname
+        _thread_root_cache.pop(dbname, None)
+
+        def signal():
+            # the sequence is not transactional, move it once the change is
+            # visible to the other workers
+            _thread_root_cache.pop(dbname, None)
+            cr.execute("SELECT nextval(%s)", [THREAD_ROOT_SIGNALING])
+
+        cr.after('commit', signal)
+        cr.after('rollback', lambda: _thread_root_cache.pop(dbname, None))
+
+    @api.model
+    def _get_thread_root_id(self, model, res_id):
+        """ Return the id of the first message of the thread of the record
+            ``res_id`` of ``model``, or False. Found roots are kept in a bounded
+            per-worker cache once the transaction that found them commits: the
+            root of a thread only changes when it is deleted or when messages
+            are moved between threads. """
+        cache = self._get_thread_root_cache()
+        try:
+            return cache[(model, res_id)]
+        except KeyError:
+            pass
+        # searched in sudo for performance, only used for id. Note that with
+        # sudo we will match message with internal subtypes.
+        root = self.sudo().search([
+            ('res_id', '=', res_id), ('model', '=', model), ('message_type', '!=', 'user_notification'),
+        ], order="id ASC", limit=1)
+        if root:
+            # the root may have been created in this transaction, which can
+            # still be rolled back
+            key, root_id = (model, res_id), root.id
+            self._cr.after('commit', lambda: cache.__setitem__(key, root_id))
+        return root.id
+
+    @api.model
+    def _get_ancestor_root_id(self, message_id):
+        """ Return the id of the oldest ancestor of the message ``message_id``
+            following parent_id, with one recursive query. A cycle stops at the
+            last message before it loops. """
+        self.flush(['parent_id'])
+        self._cr.execute("""
+            WITH RECURSIVE ancestors(id, parent_id, path) AS (
+                SELECT id, parent_id, ARRAY[id] FROM mail_message WHERE id = %s
+                 UNION ALL
+                SELECT m.id, m.parent_id, a.path || m.id
+                  FROM mail_message m JOIN ancestors a ON m.id = a.parent_id
+                 WHERE NOT m.id = ANY(a.path)
+            )
+            SELECT id FROM ancestors ORDER BY array_length(path, 1) DESC LIMIT 1
+        """, (message_id,))
+        row = self._cr.fetchone()
+        return row[0] if row else message_id
+
 
 
 class Mail(models.Model):
 
     _inherit = "mail.mail"
 
+    lease_token = fields.Char('Queue Lease', readonly=True, copy=False,
+        help='Token of the queue worker that claimed the mail for sending')
+    lease_until = fields.Datetime('Queue Lease Expiration', readonly=True, copy=False)
+
+    @api.model
+    def process_email_queue(self, ids=None):
+        """ Send the outgoing mails of the queue, by batches claimed with
+            _claim_outgoing(), so that several workers can process the queue
+            at the same time without sending a mail twice. Explicit ``ids`` and
+            ``filters`` in the context are handled as usual. """
+        if ids or 'filters' in self._context:
+            return super(Mail, self).process_email_queue(ids=ids)
+        ICP = self.env['ir.config_parameter'].sudo()
+        claim_size = int(ICP.get_param('mail.queue.claim_size', 1000))
+        lease_timeout = int(ICP.get_param('mail.queue.lease_timeout', 900))
+        auto_commit = not getattr(threading.currentThread(), 'testing', False)
+        res = None
+        # as many mails per run as the standard queue processing
+        for index in range(0, 10000, claim_size):
+            try:
+                token, claimed_ids = self._claim_outgoing(claim_size, lease_timeout)
+                if not claimed_ids:
+                    break
+                if auto_commit is True:
+                    # make the lease visible to the other workers
+                    self._cr.commit()
+                res = self.browse(claimed_ids).with_context(mail_lease_token=token).send(auto_commit=auto_commit)
+            except Exception:
+                _logger.exception("Failed processing mail queue")
+                break
+        return res
+
+    @api.model
+    def _claim_outgoing(self, limit, lease_timeout):
+        """ Lease up to ``limit`` outgoing mails due for sending for
+            ``lease_timeout`` seconds, skipping the mails claimed by other
+            workers, unless their lease has expired. Return the token of the
+            lease and the ids of the claimed mails.
+
+            ``scheduled_date`` is a Char field holding a UTC datetime in the
+            server format, it is compared as such. """
+        token = uuid.uuid4().hex
+        self.flush(['state', 'scheduled_date', 'lease_token', 'lease_until'])
+        self._cr.execute("""
+            UPDATE mail_mail
+               SET lease_token = %s,
+                   lease_until = (now() at time zone 'UTC') + %s * interval '1 second'
+             WHERE id IN (
+                    SELECT id FROM mail_mail
+                     WHERE state = 'outgoing'
+                       AND (scheduled_date IS NULL OR scheduled_date = ''
+                            OR scheduled_date < to_char(now() at time zone 'UTC', 'YYYY-MM-DD HH24:MI:SS'))
+                       AND (lease_until IS NULL OR lease_until < (now() at time zone 'UTC'))
+                  ORDER BY id
+                     LIMIT %s
+                       FOR UPDATE SKIP LOCKED)
+         RETURNING id
+        """, (token, lease_timeout, limit))
+        ids = sorted(row[0] for row in self._cr.fetchall())
+        self.invalidate_cache(['lease_token', 'lease_until'], ids)
+        return token, ids
+
+    def _send_read_attachments(self, attachments, attachment_cache):
+        """ Return the ``(name, content, mimetype)`` of ``attachments``, reading
+            and decoding only those missing from ``attachment_cache``, and the
+            MIME parts of the large attachments of the filestore, which are
+            encoded directly from their file, once per batch as long as they
+            fit in the cache. """
+        attachments = attachments.sudo()
+        keys = []
+        parts = []
+        for a in attachments.read(['checksum', 'store_fname', 'file_size', 'name', 'mimetype']):
+            if a['store_fname'] and (a['file_size'] or 0) >= ATTACHMENT_STREAM_MIN_SIZE:
+                path = attachments._full_path(a['store_fname'])
+                if os.path.isfile(path):
+                    part_key = ('part', a['id'], a['checksum'])
+                    part = attachment_cache.get(part_key)
+                    if part is None:
+                        part = _attachment_mime_part(path, a['name'], a['mimetype'])
+                        attachment_cache.set(part_key, part, len(part.get_payload()))
+                    parts.append(part)
+                    continue
+            keys.append((a['id'], a['checksum']))
+        # take the cached payloads first, caching the missing ones may evict them
+        payloads = {}
+        for key in keys:
+            payload = attachment_cache.get(key)
+            if payload is not None:
+                payloads[key] = payload
+        missing = [attachment_id for attachment_id, checksum in keys if (attachment_id, checksum) not in payloads]
+        # load attachment binary data with a separate read(), as prefetching all
+        # `datas` (binary field) could bloat the browse cache, triggerring
+        # soft/hard mem limits with temporary data.
+        for a in attachments.browse(missing).read(['name', 'datas', 'mimetype', 'checksum']):
+            payload = (a['name'], base64.b64decode(a['datas']), a['mimetype'])
+            payloads[(a['id'], a['checksum'])] = payload
+            attachment_cache.set((a['id'], a['checksum']), payload)
+        return [payloads[key] for key in keys], parts
+
+    def _send_prepare_cc_bcc(self):
+        """ Return ``{mail id: (email_cc, email_bcc)}``, the complete cc and bcc
+            address lists of the mails of ``self``, reading the partners of all
+            the mails at once. """
+        mails_data = self.exists().read(['email_cc', 'email_bcc', 'cc_recipient_ids', 'bcc_recipient_ids'])
+        partner_ids = set()
+        for data in mails_data:
+            partner_ids.update(data['cc_recipient_ids'])
+            partner_ids.update(data['bcc_recipient_ids'])
+        # same address format as _send_prepare_values(partner=partner)
+        addresses = {
+            partner['id']: tools.formataddr((partner['name'] or 'False', partner['email'] or 'False'))
+            for partner in self.env['res.partner'].sudo().browse(list(partner_ids)).read(['name', 'email'])
+        }
+        return {
+            data['id']: (
+                tools.email_split(data['email_cc']) + [addresses[pid] for pid in data['cc_recipient_ids']],
+                tools.email_split(data['email_bcc']) + [addresses[pid] for pid in data['bcc_recipient_ids']],
+            )
+            for data in mails_data
+        }
+
+    @api.model
+    def _send_group_emails(self, email_list):
+        """ Merge the entries of ``email_list`` (values of _send_prepare_values()
+            with their ``partner_id``) that only differ by their recipients, so
+            that each payload is built and transmitted once, to all of them.
+            Entries without any valid address stay alone, they fail on their
+            own. Return a list of values with the ``recipients`` they reach, as
+            ``(partner or None, email_to)``. """
+        groups = OrderedDict()
+        for index, email in enumerate(email_list):
+            email = dict(email)
+            partner = email.pop('partner_id', None)
+            email_to = email.pop('email_to', None) or []
+            if any(extract_rfc2822_addresses(address) for address in email_to):
+                key = repr(sorted(email.items()))
+            else:
+                key = index
+            if key not in groups:
+                groups[key] = dict(email, email_to=[], recipients=[])
+            groups[key]['email_to'].extend(email_to)
+            groups[key]['recipients'].append((partner, email_to))
+        return list(groups.values())
+
+    @api.model
+    def _send_split_refused(self, recipients, refused):
+        """ Return the partners of ``recipients`` reached and not reached,
+            the latter having all their addresses in ``refused``, the envelope
+            addresses refused by the SMTP server. """
+        refused = {address.lower() for address in refused}
+        delivered, failed = [], []
+        for partner, email_to in recipients:
+            if not partner:
+                continue
+            addresses = [address.lower() for base in email_to for address in extract_rfc2822_addresses(base)]
+            if addresses and all(address in refused for address in addresses):
+                failed.append(partner)
+            else:
+                delivered.append(partner)
+        return delivered, failed
+
+    def _send_grouped(self, message, smtp_session=None):
+        """ Deliver ``message`` to all its recipients in one SMTP transaction
+            and return its Message-Id, or None when all the recipients were
+            refused, and the refused envelope addresses. The message does not
+            go through send_email(), see _send_prepare_envelope(). """
+        IrMailServer = self.env['ir.mail_server']
+        smtp_from, smtp_to_list = self._send_prepare_envelope(message)
+        if getattr(threading.currentThread(), 'testing', False) or self.env.registry.in_test_mode():
+            # same as send_email(), never send in test mode
+            return message['Message-Id'], set()
+        smtp = smtp_session or IrMailServer.connect(mail_server_id=self.mail_server_id.id)
+        try:
+            refused = smtp.sendmail(smtp_from, smtp_to_list, message.as_string())
+        except smtplib.SMTPRecipientsRefused as error:
+            return None, set(error.recipients)
+        finally:
+            if not smtp_session:
+                smtp.quit()
+        return message['Message-Id'], set(refused)
+
+    def _send_lock_batch(self, attempt=None):
+        """ Put the mails of ``self`` that are still outgoing and their pending
+            email notifications in a transient exception state, before any of
+            them is sent, and return those mails. With a ``mail_lease_token`` in
+            the context, only the mails still leased with it are taken. The
+            mails keep the token ``attempt`` of the send attempt, see
+            _send_check_attempt(). """
+        # Writing on the mail object may fail (e.g. lock on user) which
+        # would trigger a rollback *after* actually sending the email.
+        # To avoid sending twice the same email, provoke the failure earlier.
+        # The state is checked by the update itself: of two workers sending
+        # the same mail, only the first one to update it gets it.
+        # The lease token is replaced by the token of the send attempt: once
+        # this is committed, the mails are never taken from the queue again.
+        self.flush(['state', 'failure_reason', 'lease_token'])
+        token = self._context.get('mail_lease_token')
+        self._cr.execute("""
+            UPDATE mail_mail
+               SET state = 'exception', failure_reason = %s, lease_token = %s,
+                   write_uid = %s, write_date = (now() at time zone 'UTC')
+             WHERE id = ANY(%s) AND state = 'outgoing' {}
+         RETURNING id
+        """.format('AND lease_token = %s' if token else ''), [
+            _('Error without exception. Probably due do sending an email without computed recipients.'),
+            attempt or uuid.uuid4().hex, self.env.uid, self.ids,
+        ] + ([token] if token else []))
+        self.invalidate_cache(['state', 'failure_reason', 'lease_token', 'write_uid', 'write_date'], self.ids)
+        self = self.browse(sorted(row[0] for row in self._cr.fetchall()))
+        if not self:
+            return self
+        # Update notification in a transient exception state to avoid concurrent
+        # update in case an email bounces while sending all emails related to current
+        # mail record.
+        notifs = self.env['mail.notification'].search([
+            ('notification_type', '=', 'email'),
+            ('mail_id', 'in', self.ids),
+            ('notification_status', 'not in', ('sent', 'canceled'))
+        ])
+        if notifs:
+            notif_msg = _('Error without exception. Probably due do concurrent access update of notification records. Please see with an administrator.')
+            notifs.sudo().write({
+                'notification_status': 'exception',
+                'failure_type': 'UNKNOWN',
+                'failure_reason': notif_msg,
+            })
+            # `test_mail_bounce_during_send`, force immediate update to obtain the lock.
+            # see rev. 56596e5240ef920df14d99087451ce6f06ac6d36
+            notifs.flush(fnames=['notification_status', 'failure_type', 'failure_reason'], records=notifs)
+        return self
+
+    def _send_check_attempt(self, attempt):
+        """ Return whether the mail ``self`` is still locked by the send
+            attempt ``attempt``, and not put back in the queue and taken by
+            another one since it was locked. """
+        self.ensure_one()
+        self._cr.execute("SELECT lease_token FROM mail_mail WHERE id = %s AND state = 'exception'", [self.id])
+        row = self._cr.fetchone()
+        return bool(row) and row[0] == attempt
+
+    def _send_unlock_batch(self):
+        """ Put the mails of ``self``, locked by _send_lock_batch() but not
+            sent, and their notifications back in the queue. """
+        self.write({'state': 'outgoing', 'failure_reason': False, 'lease_token': False, 'lease_until': False})
+        notifs = self.env['mail.notification'].search([
+            ('notification_type', '=', 'email'),
+            ('mail_id', 'in', self.ids),
+            ('notification_status', '=', 'exception')
+        ])
+        notifs.sudo().write({'notification_status': 'ready', 'failure_type': False, 'failure_reason': False})
+
+    def _send_unlock_after_error(self):
+        """ Same as _send_unlock_batch(), from a new cursor, the cursor of the
+            current transaction being unusable after a database error. """
+        if not self:
+            return
+        with self.pool.cursor() as cr:
+            self.with_env(self.env(cr=cr))._send_unlock_batch()
+
+    def _send_failure(self, error, success_pids, raise_exception):
+        """ Mark the mail as failed because of ``error``, re-raising it as a
+            MailDeliveryException when asked to. """
+        failure_reason = tools.ustr(error)
+        _logger.exception('failed sending mail (id: %s) due to %s', self.id, failure_reason)
+        self.write({'state': 'exception', 'failure_reason': failure_reason})
+        self._postprocess_sent_message(success_pids=success_pids, failure_reason=failure_reason, failure_type='UNKNOWN')
+        if raise_exception:
+            if isinstance(error, (AssertionError, UnicodeEncodeError)):
+                if isinstance(error, UnicodeEncodeError):
+                    value = "Invalid text: %s" % error.object
+                else:
+                    # get the args of the original error, wrap into a value and throw a MailDeliveryException
+                    # that is an except_orm, with name and value as arguments
+                    value = '. '.join(error.args)
+                raise MailDeliveryException(_("Mail Delivery Failed"), value)
+            raise error
+
+    def _send_postprocess_batch(self, results):
+        """ Apply the outcome of the mails of a _send() batch with grouped writes,
+            ``results`` being ``{mail: (message_id, success_pids, failure_type)}``
+            where ``message_id`` is None for the mails that were not sent. """
+        sent = self.browse([mail.id for mail, (res, pids, failure_type) in results.items() if res])
+        if sent:
+            sent.write({'state': 'sent', 'failure_reason': False})
+        for mail, (res, success_pids, failure_type) in results.items():
+            if res:
+                if res != mail.message_id:
+                    mail.write({'message_id': res})
+                _logger.info('Mail with ID %r and Message-Id %r successfully sent', mail.id, mail.message_id)
+        # success_pids only matter for failures: mails sent without failure
+        # are post-processed together
+        groups = defaultdict(list)
+        for mail, (res, success_pids, failure_type) in results.items():
+            pids = tuple(sorted(partner.id for partner in success_pids)) if failure_type else ()
+            groups[(failure_type, pids)].append(mail.id)
+        for (failure_type, pids), mail_ids in groups.items():
+            self.browse(mail_ids)._postprocess_sent_message(
+                success_pids=list(self.env['res.partner'].browse(pids)), failure_type=failure_type)
+
+    def _send_smtp_pool(self, mail_server_id, size):
+        """ Return a SmtpPool of ``size`` connections to the given mail server,
+            or to the default one. """
+        IrMailServer = self.env['ir.mail_server'].sudo()
+        mail_server = IrMailServer.browse(mail_server_id) if mail_server_id else \
+            IrMailServer.search([], order='sequence', limit=1)
+        if mail_server:
+            connect_params = {
+                'host': mail_server.smtp_host,
+                'port': mail_server.smtp_port,
+                'user': mail_server.smtp_user,
+                'password': mail_server.smtp_pass,
+                'encryption': mail_server.smtp_encryption,
+                'smtp_debug': mail_server.smtp_debug,
+            }
+        else:
+            connect_params = {
+                'host': tools.config.get('smtp_server'),
+                'port': tools.config.get('smtp_port', 25),
+                'user': tools.config.get('smtp_user'),
+                'password': tools.config.get('smtp_password'),
+                'encryption': 'starttls' if tools.config.get('smtp_ssl') else None,
+                'smtp_debug': tools.config.get('smtp_debug'),
+            }
+        return SmtpPool(IrMailServer.connect, connect_params, size)
+
+    def _send_prepare_envelope(self, message):
+        """ Return the SMTP envelope ``(smtp_from, smtp_to_list)`` of ``message``
+            and adapt its headers, as ir.mail_server.send_email() does before
+            sending it.
+
+            The messages delivered with this envelope, by the SMTP pools and
+            for grouped emails, do not go through send_email(): its overrides
+            are not applied to them and must be ported here if they matter. """
+        IrMailServer = self.env['ir.mail_server']
+        smtp_from = message['Return-Path'] or IrMailServer._get_default_bounce_address() or message['From']
+        assert smtp_from, "The Return-Path or From header is required for any outbound email"
+        from_rfc2822 = extract_rfc2822_addresses(smtp_from)
+        assert from_rfc2822, ("Malformed 'Return-Path' or 'From' address: %r - "
+                              "It should contain one valid plain ASCII email") % smtp_from
+        smtp_from = from_rfc2822[-1]
+        email_bcc = message['Bcc']
+        del message['Bcc']
+        smtp_to_list = [
+            address
+            for base in [message['To'], message['Cc'], email_bcc]
+            for address in extract_rfc2822_addresses(base)
+            if address
+        ]
+        assert smtp_to_list, IrMailServer.NO_VALID_RECIPIENT
+        x_forge_to = message['X-Forge-To']
+        if x_forge_to:
+            del message['X-Forge-To']
+            del message['To']
+            message['To'] = x_forge_to
+        return smtp_from, smtp_to_list
+
     def _send(self, auto_commit=False, raise_exception=False, smtp_session=None):
         IrMailServer = self.env['ir.mail_server']
         IrAttachment = self.env['ir.attachment']
-        for mail_id in self.ids:
-            success_pids = []
-            failure_type = None
-            processing_pid = None
-            mail = None
-            try:
-                mail = self.browse(mail_id)
-                if mail.state != 'outgoing':
-                    if mail.state != 'exception' and mail.auto_delete:
-                        mail.sudo().unlink()
+        # prefetch the whole batch, skip the mails that are not outgoing anymore
+        batch = self.exists()
+        mails = batch.filtered(lambda mail: mail.state == 'outgoing')
+        batch.filtered(lambda mail: mail.state not in ('outgoing', 'exception') and mail.auto_delete).sudo().unlink()
+        if not mails:
+            return True
+
+        attachment_cache = AttachmentCache()
+        cc_bcc_lists = mails._send_prepare_cc_bcc()
+        ICP = self.env['ir.config_parameter'].sudo()
+        bounce_alias = ICP.get_param("mail.bounce.alias")
+        catchall_domain = ICP.get_param("mail.catchall.domain")
+        # number of SMTP connections per mail server delivering in parallel,
+        # emails are never actually sent in test mode; the pools deliver
+        # without send_email(), see _send_prepare_envelope()
+        concurrency = int(ICP.get_param('mail.smtp.concurrency', 1))
+        if getattr(threading.currentThread(), 'testing', False) or self.env.registry.in_test_mode():
+            concurrency = 1
+        smtp_pools = {}
+        # (mail, recipients, email_to, future) of the emails handed to the pools
+        deliveries = []
+        # with auto_commit, the mails are locked, sent and saved by groups of
+        # commit_size mails, so that a failure only leaves the mails of one
+        # group locked; their outcome is also saved every commit_interval
+        # seconds. A commit_size of 0 locks and saves the batch at once.
+        commit_size = int(ICP.get_param('mail.send.commit_size', 20))
+        commit_interval = float(ICP.get_param('mail.send.commit_interval', 0))
+        if auto_commit is not True or not commit_size:
+            commit_size = len(mails)
+        groups = [mails[index:index + commit_size] for index in range(0, len(mails), commit_size)]
+
+        # {mail: (message_id, success_pids, failure_type)}, applied once the group is done
+        results = {}
+
+        def collect_deliveries():
+            # collect the outcome of the emails delivered in parallel, the
+            # database state is only updated from this thread; a mail fails
+            # once all its deliveries are done, with the partners reached
+            failures = OrderedDict()
+            for mail, recipients, email_to, future in deliveries:
+                try:
+                    res, refused = future.result()
+                except smtplib.SMTPRecipientsRefused as e:
+                    res, refused = None, set(e.recipients)
+                except Exception as e:
+                    _logger.info("Parallel delivery of mail.mail %s to %s failed", mail.message_id, email_to)
+                    failures.setdefault(mail, e)
                     continue
-
-                # remove attachments if user send the link with the access_token
-                body = mail.body_html or ''
-                attachments = mail.attachment_ids
-                for link in re.findall(r'/web/(?:content|image)/([0-9]+)', body):
-                    attachments = attachments - IrAttachment.browse(int(link))
-
-                # load attachment binary data with a separate read(), as prefetching all
-                # `datas` (binary field) could bloat the browse cache, triggerring
-                # soft/hard mem limits with temporary data.
-                attachments = [(a['name'], base64.b64decode(a['datas']), a['mimetype'])
-                               for a in attachments.sudo().read(['name', 'datas', 'mimetype'])]
-
-                # specific behavior to customize the send email for notified partners
-                email_list = []
-                cc_list = []
-                bcc_list = []
-                if mail.email_to:
-                    email_list.append(mail._send_prepare_values())
-                for partner in mail.recipient_ids:
-                    values = mail._send_prepare_values(partner=partner)
-                    values['partner_id'] = partner
-                    email_list.append(values)
-                for partner in mail.cc_recipient_ids:
-                    cc_list += mail._send_prepare_values(
-                        partner=partner).get('email_to')
-                for partner in mail.bcc_recipient_ids:
-                    bcc_list += mail._send_prepare_values(
-                        partner=partner).get('email_to')
-
-                # headers
-                headers = {}
-                ICP = self.env['ir.config_parameter'].sudo()
-                bounce_alias = ICP.get_param("mail.bounce.alias")
-                catchall_domain = ICP.get_param("mail.catchall.domain")
-                if bounce_alias and catchall_domain:
-                    if mail.mail_message_id.is_thread_message():
-                        headers['Return-Path'] = '%s+%d-%s-%d@%s' % (bounce_alias, mail.id, mail.model, mail.res_id, catchall_domain)
-                    else:
-                        headers['Return-Path'] = '%s+%d@%s' % (bounce_alias, mail.id, catchall_domain)
-                if mail.headers:
-                    try:
-                        headers.update(safe_eval(mail.headers))
-                    except Exception:
-                        pass
-
-                # Writing on the mail object may fail (e.g. lock on user) which
-                # would trigger a rollback *after* actually sending the email.
-                # To avoid sending twice the same email, provoke the failure earlier
-                mail.write({
-                    'state': 'exception',
-                    'failure_reason': _('Error without exception. Probably due do sending an email without computed recipients.'),
-                })
-                # Update notification in a transient exception state to avoid concurrent
-                # update in case an email bounces while sending all emails related to current
-                # mail record.
-                notifs = self.env['mail.notification'].search([
-                    ('notification_type', '=', 'email'),
-                    ('mail_id', 'in', mail.ids),
-                    ('notification_status', 'not in', ('sent', 'canceled'))
-                ])
-                if notifs:
-                    notif_msg = _('Error without exception. Probably due do concurrent access update of notification records. Please see with an administrator.')
-                    notifs.sudo().write({
-                        'notification_status': 'exception',
-                        'failure_type': 'UNKNOWN',
-                        'failure_reason': notif_msg,
-                    })
-                    # `test_mail_bounce_during_send`, force immediate update to obtain the lock.
-                    # see rev. 56596e5240ef920df14d99087451ce6f06ac6d36
-                    notifs.flush(fnames=['notification_status', 'failure_type', 'failure_reason'], records=notifs)
-
-                # build an RFC2822 email.message.Message object and send it without queuing
-                res = None
-                for email in email_list:
-                    msg = IrMailServer.build_email(
-                        email_from=mail.email_from,
-                        email_to=email.get('email_to'),
-                        subject=mail.subject,
-                        body=email.get('body'),
-                        body_alternative=email.get('body_alternative'),
-                        email_cc=tools.email_split(mail.email_cc)+ cc_list,
-                        email_bcc=tools.email_split(mail.email_bcc) + bcc_list,
-                        reply_to=mail.reply_to,
-                        attachments=attachments,
-                        message_id=mail.message_id,
-                        references=mail.references,
-                        object_id=mail.res_id and ('%s-%s' % (mail.res_id, mail.model)),
-                        subtype='html',
-                        subtype_alternative='plain',
-                        headers=headers)
-
-                    processing_pid = email.pop("partner_id", None)
+                if mail in results:
+                    sent_res, success_pids, failure_type = results[mail]
+                    delivered, failed = self._send_split_refused(recipients, refused)
+                    success_pids.extend(delivered)
+                    if refused:
+                        failure_type = "RECIPIENT"
+                    results[mail] = (res or sent_res, success_pids, failure_type)
+            del deliveries[:]
+            failures = [(mail, error) for mail, error in failures.items() if mail in results]
+            for index, (mail, error) in enumerate(failures, start=1):
+                # only the last failure may raise, once all are saved
+                success_pids = results.pop(mail)[1]
+                mail._send_failure(error, success_pids, raise_exception and index == len(failures))
+
+        attempt = uuid.uuid4().hex
+        locked = groups.pop(0)._send_lock_batch(attempt)
+        if auto_commit is True:
+            # from now on, a rollback cannot put the mails back in the queue
+            self._cr.commit()
+        commit_time = time.time()
+        try:
+            while True:
+                processed = attempted = self.browse()
+                for mail in locked:
+                    attempted |= mail
+                    if not mail._send_check_attempt(attempt):
+                        # retried and sent by another worker since it was locked
+                        _logger.info('Mail with ID %r is sent by another attempt, skipped', mail.id)
+                        processed |= mail
+                        continue
+                    success_pids = []
+                    failure_type = None
                     try:
-                        res = IrMailServer.send_email(
-                            msg, mail_server_id=mail.mail_server_id.id, smtp_session=smtp_session)
-                        if processing_pid:
-                            success_pids.append(processing_pid)
-                        processing_pid = None
-                    except AssertionError as error:
-                        if str(error) == IrMailServer.NO_VALID_RECIPIENT:
-                            failure_type = "RECIPIENT"
-                            # No valid recipient found for this particular
-                            # mail item -> ignore error to avoid blocking
-                            # delivery to next recipients, if any. If this is
-                            # the only recipient, the mail will show as failed.
-                            _logger.info("Ignoring invalid recipients for mail.mail %s: %s",
-                                         mail.message_id, email.get('email_to'))
-                        else:
-                            raise
-                if res:  # mail has been sent at least once, no major exception occured
-                    mail.write({'state': 'sent', 'message_id': res, 'failure_reason': False})
-                    _logger.info('Mail with ID %r and Message-Id %r successfully sent', mail.id, mail.message_id)
-                    # /!\ can't use mail.state here, as mail.refresh() will cause an error
-                    # see revid:odo@openerp.com-20120622152536-42b2s28lvdv3odyr in 6.1
-                mail._postprocess_sent_message(success_pids=success_pids, failure_type=failure_type)
-            except MemoryError:
-                # prevent catching transient MemoryErrors, bubble up to notify user or abort cron job
-                # instead of marking the mail as failed
-                _logger.exception(
-                    'MemoryError while processing mail with ID %r and Msg-Id %r. Consider raising the --limit-memory-hard startup option',
-                    mail.id, mail.message_id)
-                # mail status will stay on ongoing since transaction will be rollback
-                raise
-            except (psycopg2.Error, smtplib.SMTPServerDisconnected):
-                # If an error with the database or SMTP session occurs, chances are that the cursor
-                # or SMTP session are unusable, causing further errors when trying to save the state.
-                _logger.exception(
-                    'Exception while processing mail with ID %r and Msg-Id %r.',
-                    mail.id, mail.message_id)
-                raise
-            except Exception as e:
-                failure_reason = tools.ustr(e)
-                _logger.exception('failed sending mail (id: %s) due to %s', mail.id, failure_reason)
-                mail.write({'state': 'exception', 'failure_reason': failure_reason})
-                mail._postprocess_sent_message(success_pids=success_pids, failure_reason=failure_reason, failure_type='UNKNOWN')
-                if raise_exception:
-                    if isinstance(e, (AssertionError, UnicodeEncodeError)):
-                        if isinstance(e, UnicodeEncodeError):
-                            value = "Invalid text: %s" % e.object
-                        else:
-                            # get the args of the original error, wrap into a value and throw a MailDeliveryException
-                            # that is an except_orm, with name and value as arguments
-                            value = '. '.join(e.args)
-                        raise MailDeliveryException(_("Mail Delivery Failed"), value)
-                    raise
-
+                        # remove attachments if user send the link with the access_token
+                        body = mail.body_html or ''
+                        attachments = mail.attachment_ids
+                        for link in re.findall(r'/web/(?:content|image)/([0-9]+)', body):
+                            attachments = attachments - IrAttachment.browse(int(link))
+
+                        attachments, attachment_parts = self._send_read_attachments(attachments, attachment_cache)
+
+                        # specific behavior to customize the send email for notified partners
+                        email_list = []
+                        if mail.email_to:
+                            email_list.append(mail._send_prepare_values())
+                        for partner in mail.recipient_ids:
+                            values = mail._send_prepare_values(partner=partner)
+                            values['partner_id'] = partner
+                            email_list.append(values)
+                        email_list = self._send_group_emails(email_list)
+                        email_cc, email_bcc = cc_bcc_lists[mail.id]
+
+                        # headers
+                        headers = {}
+                        if bounce_alias and catchall_domain:
+                            if mail.mail_message_id.is_thread_message():
+                                headers['Return-Path'] = '%s+%d-%s-%d@%s' % (bounce_alias, mail.id, mail.model, mail.res_id, catchall_domain)
+                            else:
+                                headers['Return-Path'] = '%s+%d@%s' % (bounce_alias, mail.id, catchall_domain)
+                        if mail.headers:
+                            try:
+                                headers.update(safe_eval(mail.headers))
+                            except Exception:
+                                pass
+
+                        # build an RFC2822 email.message.Message object and send it without queuing
+                        res = None
+                        for email in email_list:
+                            # the recipients of a grouped email are only in
+                            # the envelope, they do not see each other
+                            grouped = len(email['recipients']) > 1
+                            msg = IrMailServer.build_email(
+                                email_from=mail.email_from,
+                                email_to=email.get('email_to'),
+                                subject=mail.subject,
+                                body=email.get('body'),
+                                body_alternative=email.get('body_alternative'),
+                                email_cc=email_cc,
+                                email_bcc=email_bcc,
+                                reply_to=mail.reply_to,
+                                attachments=attachments,
+                                message_id=mail.message_id,
+                                references=mail.references,
+                                object_id=mail.res_id and ('%s-%s' % (mail.res_id, mail.model)),
+                                subtype='html',
+                                subtype_alternative='plain',
+                                headers=dict(headers, **{'X-Forge-To': 'undisclosed-recipients:;'}) if grouped else headers)
+                            for part in attachment_parts:
+                                msg.attach(part)
+
+                            try:
+                                if concurrency > 1:
+                                    server_id = mail.mail_server_id.id
+                                    if server_id not in smtp_pools:
+                                        smtp_pools[server_id] = self._send_smtp_pool(server_id, concurrency)
+                                    smtp_from, smtp_to_list = self._send_prepare_envelope(msg)
+                                    future = smtp_pools[server_id].submit(smtp_from, smtp_to_list, msg)
+                                    deliveries.append((mail, email['recipients'], email.get('email_to'), future))
+                                    continue
+                                if grouped:
+                                    message_id, refused = mail._send_grouped(msg, smtp_session=smtp_session)
+                                else:
+                                    message_id, refused = IrMailServer.send_email(
+                                        msg, mail_server_id=mail.mail_server_id.id, smtp_session=smtp_session), set()
+                                res = message_id or res
+                                delivered, failed = self._send_split_refused(email['recipients'], refused)
+                                success_pids.extend(delivered)
+                                if refused:
+                                    failure_type = "RECIPIENT"
+                                    _logger.info("Recipients refused for mail.mail %s: %s",
+                                                 mail.message_id, ', '.join(sorted(refused)))
+                            except AssertionError as error:
+                                if str(error) == IrMailServer.NO_VALID_RECIPIENT:
+                                    failure_type = "RECIPIENT"
+                                    # No valid recipient found for this particular
+                                    # mail item -> ignore error to avoid blocking
+                                    # delivery to next recipients, if any. If this is
+                                    # the only recipient, the mail will show as failed.
+                                    _logger.info("Ignoring invalid recipients for mail.mail %s: %s",
+                                                 mail.message_id, email.get('email_to'))
+                                else:
+                                    raise
+                        # mail has been sent at least once if res is set, no major exception occured,
+                        # the emails delivered by the SMTP pools are accounted for below
+                        results[mail] = (res, success_pids, failure_type)
+                        processed |= mail
+                    except MemoryError:
+                        # prevent catching transient MemoryErrors, bubble up to notify user or abort cron job
+                        # instead of marking the mail as failed
+                        _logger.exception(
+                            'MemoryError while processing mail with ID %r and Msg-Id %r. Consider raising the --limit-memory-hard startup option',
+                            mail.id, mail.message_id)
+                        raise
+                    except (psycopg2.Error, smtplib.SMTPServerDisconnected):
+                        # If an error with the database or SMTP session occurs, chances are that the cursor
+                        # or SMTP session are unusable, causing further errors when trying to save the state.
+                        _logger.exception(
+                            'Exception while processing mail with ID %r and Msg-Id %r.',
+                            mail.id, mail.message_id)
+                        raise
+                    except Exception as e:
+                        results.pop(mail, None)
+                        processed |= mail
+                        mail._send_failure(e, success_pids, raise_exception)
+
+                    # the mails delivered by the SMTP pools only have an outcome at the end of the group
+                    if auto_commit is True and commit_interval and not deliveries and \
+                            time.time() - commit_time >= commit_interval:
+                        mails._send_postprocess_batch(results)
+                        results = {}
+                        self._cr.commit()
+                        commit_time = time.time()
+
+                collect_deliveries()
+
+                # save the outcome of the group and lock the next one at once
+                mails._send_postprocess_batch(results)
+                results = {}
+                locked = self.browse()
+                while groups and not locked:
+                    locked = groups.pop(0)._send_lock_batch(attempt)
+                if auto_commit is True:
+                    self._cr.commit()
+                    commit_time = time.time()
+                if not locked:
+                    break
+        except psycopg2.Error:
+            # the cursor is unusable: the mails attempted stay in exception and
+            # are not sent twice, the others of the group go back in the queue
             if auto_commit is True:
+                (locked - attempted)._send_unlock_after_error()
+            raise
+        except Exception:
+            # the lock of the group has been committed: save the outcome of the
+            # processed mails and put the others back in the queue, as the
+            # transaction would have done without the early commit
+            if auto_commit is True:
+                collect_deliveries()
+                mails._send_postprocess_batch(results)
+                (locked - processed)._send_unlock_batch()
                 self._cr.commit()
+            raise
+        finally:
+            for smtp_pool in smtp_pools.values():
+                smtp_pool.close()
         return True
 
 
@@ -460,34 +1166,57 @@ class Thread(models.AbstractModel):
             recipient in the result dictionary. The form is :
                 partner_id, partner_name<partner_email> or partner_name, reason """
         self.ensure_one()
-        if email and not partner:
-            # get partner info from email
-            partner_info = self._message_partner_info_from_emails([email])[0]
-            if partner_info.get('partner_id'):
-                partner = self.env['res.partner'].sudo().browse([partner_info['partner_id']])[0]
-        if email and email in [val[1] for val in result[self.ids[0]]]:  # already existing email -> skip
-            return result
-        # if partner and partner in self.message_partner_ids:  # recipient already in the followers -> skip
-        #     return result
-        if partner and partner.id in [val[0] for val in result[self.ids[0]]]:  # already existing partner ID -> skip
+        if partner and email and email in [val[1] for val in result[self.id]]:  # already existing email -> skip
             return result
-        if partner and partner.email:  # complete profile: id, name <email>
-            result[self.ids[0]].append((partner.id, '%s<%s>' % (partner.name, partner.email), reason))
-        elif partner:  # incomplete profile: id, name
-            result[self.ids[0]].append((partner.id, '%s' % (partner.name), reason))
-        else:  # unknown partner, we are probably managing an email address
-            result[self.ids[0]].append((False, email, reason))
+        return self._message_add_suggested_recipients(
+            result, partners=partner, emails=[email] if email and not partner else [], reason=reason)
+
+    def _message_add_suggested_recipients(self, result, partners=None, emails=(), reason=''):
+        """ Batch version of _message_add_suggested_recipient: add ``partners``
+            and the partners found for ``emails`` (or the bare addresses) that
+            are not suggested yet, with one lookup of all the addresses and one
+            read of all the partners. """
+        self.ensure_one()
+        suggested = result[self.id]
+        seen_emails = {val[1] for val in suggested}
+        seen_pids = {val[0] for val in suggested}
+        Partner = self.env['res.partner'].sudo()
+        entries = [(partner, None) for partner in (partners or Partner)]
+        emails = [email for email in emails if email and email not in seen_emails]
+        if emails:
+            partner_infos = self._message_partner_info_from_emails(emails)
+            entries += [
+                (Partner.browse(info['partner_id']) if info.get('partner_id') else None, email)
+                for email, info in zip(emails, partner_infos)
+            ]
+        # one read for all the partners, before looping over them
+        Partner.browse([partner.id for partner, email in entries if partner]).read(['name', 'email'])
+        for partner, email in entries:
+            if email and email in seen_emails:  # already existing email -> skip
+                continue
+            # if partner and partner in self.message_partner_ids:  # recipient already in the followers -> skip
+            #     continue
+            if partner and partner.id in seen_pids:  # already existing partner ID -> skip
+                continue
+            if partner and partner.email:  # complete profile: id, name <email>
+                suggested.append((partner.id, '%s<%s>' % (partner.name, partner.email), reason))
+            elif partner:  # incomplete profile: id, name
+                suggested.append((partner.id, '%s' % (partner.name), reason))
+            else:  # unknown partner, we are probably managing an email address
+                suggested.append((False, email, reason))
+            seen_emails.add(suggested[-1][1])
+            seen_pids.add(suggested[-1][0])
         return result
 
     def _message_get_suggested_recipients(self):
         """ Returns suggested recipients for ids. Those are a list of
         tuple (partner_id, partner_name, reason), to be managed by Chatter. """
         result = super(Thread, self)._message_get_suggested_recipients()
+        reason = self._fields['user_id'].string
         for obj in self.sudo():  # SUPERUSER because of a read on res.users that would crash otherwise
             if not obj.message_partner_ids:
                 continue
-            for partner in obj.message_partner_ids:
-                obj._message_add_suggested_recipient(result, partner=partner, reason=self._fields['user_id'].string)
+            obj._message_add_suggested_recipients(result, partners=obj.message_partner_ids, reason=reason)
         return result
 
     @api.returns('mail.message', lambda value: value.id)
@@ -560,23 +1289,11 @@ class Thread(models.AbstractModel):
         if self._context.get('mail_post_autofollow') and partner_ids:
             self.message_subscribe(list(partner_ids))
 
-        MailMessage_sudo = self.env['mail.message'].sudo()
+        MailMessage = self.env['mail.message']
         if self._mail_flat_thread and not parent_id:
-            parent_message = MailMessage_sudo.search([('res_id', '=', self.id), ('model', '=', self._name), ('message_type', '!=', 'user_notification')], order="id ASC", limit=1)
-            # parent_message searched in sudo for performance, only used for id.
-            # Note that with sudo we will match message with internal subtypes.
-            parent_id = parent_message.id if parent_message else False
+            parent_id = MailMessage._get_thread_root_id(self._name, self.id)
         elif parent_id:
-            old_parent_id = parent_id
-            parent_message = MailMessage_sudo.search([('id', '=', parent_id), ('parent_id', '!=', False)], limit=1)
-            # avoid loops when finding ancestors
-            processed_list = []
-            if parent_message:
-                new_parent_id = parent_message.parent_id and parent_message.parent_id.id
-                while (new_parent_id and new_parent_id not in processed_list):
-                    processed_list.append(new_parent_id)
-                    parent_message = parent_message.parent_id
-                parent_id = parent_message.id
+            parent_id = MailMessage._get_ancestor_root_id(parent_id)
 
         cc_partner_ids = set()
         cc_recipient_ids = kwargs.pop('cc_recipient_ids', [])
@@ -646,19 +1363,23 @@ class Thread(models.AbstractModel):
         # get values from msg_vals or from message if msg_vals doen't exists
         pids = msg_vals.get('partner_ids', []) if msg_vals else msg_sudo.partner_ids.ids
         cids = msg_vals.get('channel_ids', []) if msg_vals else msg_sudo.channel_ids.ids
-        message_type = msg_vals.get('message_type') if msg_vals else msg_sudo.message_type
         subtype_id = msg_vals.get('subtype_id') if msg_vals else msg_sudo.subtype_id.id
         # is it possible to have record but no subtype_id ?
         recipient_data = {
             'partners': [],
             'channels': [],
         }
-        res = self.env['mail.followers']._get_recipient_data(self, message_type, subtype_id, pids, cids)
+        res = self._notify_get_recipient_rows(subtype_id, pids, cids)
         if not res:
             return recipient_data
 
         author_id = msg_vals.get('author_id') or message.author_id.id
-        for pid, cid, active, pshare, ctype, notif, groups in res:
+        channel_partners = []
+        for pid, cid, active, pshare, ctype, notif, groups, email in res:
+            if ctype == 'channel_email':
+                # partners of the email channels, added once the others are known
+                channel_partners.append((pid, email))
+                continue
             if pid and pid == author_id and not self.env.context.get('mail_notify_author'):  # do not notify the author of its own messages
                 continue
             if pid:
@@ -676,26 +1397,188 @@ class Thread(models.AbstractModel):
             elif cid:
                 recipient_data['channels'].append({'id': cid, 'notif': notif, 'type': ctype})
 
-        # add partner ids in email channels
-        email_cids = [r['id'] for r in recipient_data['channels'] if r['notif'] == 'email']
-        if email_cids:
-            # we are doing a similar search in ocn_client
-            # Could be interesting to make everything in a single query.
-            # ocn_client: (searching all partners linked to channels of type chat).
-            # here      : (searching all partners linked to channels with notif email if email is not the author one)
-            # TDE FIXME: use email_sanitized
-            email_from = msg_vals.get('email_from') or message.email_from
-            exept_partner = [r['id'] for r in recipient_data['partners']]
-            if author_id:
-                exept_partner.append(author_id)
-            new_pids = self.env['res.partner'].sudo().search([
-                ('id', 'not in', exept_partner),
-                ('channel_ids', 'in', email_cids),
-                ('email', 'not in', [email_from]),
-            ])
-            for partner in new_pids:
-                # caution: side effect, if user has notif type inbox, will receive en email anyway?
-                # ocn_client: will add partners to recipient recipient_data. more ocn notifications. We neeed to filter them maybe
-                recipient_data['partners'].append({'id': partner.id, 'share': True, 'active': True, 'notif': 'email', 'type': 'channel_email', 'groups': []})
+        # add partner ids in email channels, if email is not the author one
+        # TDE FIXME: use email_sanitized
+        email_from = msg_vals.get('email_from') or message.email_from
+        exept_partner = {r['id'] for r in recipient_data['partners']}
+        if author_id:
+            exept_partner.add(author_id)
+        for pid, email in channel_partners:
+            if pid in exept_partner or (email_from and email == email_from):
+                continue
+            exept_partner.add(pid)
+            # caution: side effect, if user has notif type inbox, will receive en email anyway?
+            # ocn_client: will add partners to recipient recipient_data. more ocn notifications. We neeed to filter them maybe
+            recipient_data['partners'].append({'id': pid, 'share': True, 'active': True, 'notif': 'email', 'type': 'channel_email', 'groups': []})
 
         return recipient_data
+
+    def _notify_get_recipient_rows(self, subtype_id, pids, cids):
+        """ Return the rows ``(pid, cid, active, pshare, ctype, notif, groups,
+            email)`` of the followers of ``self`` subscribed to ``subtype_id``,
+            of the partners ``pids`` and channels ``cids``, and of the members
+            of the email channels among them (with ctype ``channel_email``), as
+            mail.followers._get_recipient_data() does for the first ones.
+
+            All of them are fetched with one query, and kept for the rest of the
+            transaction, until followers or channel members change. """
+        if not pids and not cids and not (self and subtype_id):
+            return []
+        key = (self._name, tuple(self.ids), subtype_id, frozenset(pids), frozenset(cids))
+        cache = self._notify_recipient_rows_cache()
+        if key in cache:
+            return cache[key]
+        self.env['mail.followers'].flush(['partner_id', 'channel_id', 'subtype_ids', 'res_model', 'res_id'])
+        self.env['mail.channel'].flush(['email_send', 'channel_type'])
+        self.env['mail.channel.partner'].flush(['channel_id', 'partner_id'])
+        self.env['res.partner'].flush(['active', 'partner_share', 'email'])
+        self.env['res.users'].flush(['notification_type', 'partner_id', 'active', 'groups_id'])
+        self._cr.execute("""
+            WITH sub_followers AS (
+                SELECT fol.id, fol.partner_id, fol.channel_id, subtype.internal
+                  FROM mail_followers fol
+                  JOIN mail_followers_mail_message_subtype_rel subrel ON subrel.mail_followers_id = fol.id
+                  JOIN mail_message_subtype subtype ON subtype.id = subrel.mail_message_subtype_id
+                 WHERE subrel.mail_message_subtype_id = %(subtype_id)s
+                   AND fol.res_model = %(model)s AND fol.res_id = ANY(%(res_ids)s)
+            ), channels AS (
+                SELECT channel.id, channel.channel_type, channel.email_send
+                  FROM mail_channel channel
+                 WHERE EXISTS (SELECT 1 FROM sub_followers
+                                WHERE sub_followers.partner_id IS NULL AND sub_followers.channel_id = channel.id)
+                    OR channel.id = ANY(%(cids)s)
+            )
+            SELECT partner.id AS pid, NULL::int AS cid,
+                   partner.active AS active, partner.partner_share AS pshare, NULL AS ctype,
+                   users.notification_type AS notif, array_agg(groups.id) AS groups, NULL AS email
+              FROM res_partner partner
+         LEFT JOIN res_users users ON users.partner_id = partner.id AND users.active
+         LEFT JOIN res_groups_users_rel groups_rel ON groups_rel.uid = users.id
+         LEFT JOIN res_groups groups ON groups.id = groups_rel.gid
+             WHERE EXISTS (SELECT 1 FROM sub_followers
+                            WHERE sub_followers.channel_id IS NULL
+                              AND sub_followers.partner_id = partner.id
+                              AND (coalesce(sub_followers.internal, false) <> TRUE
+                                   OR coalesce(partner.partner_share, false) <> TRUE))
+                OR partner.id = ANY(%(pids)s)
+          GROUP BY partner.id, users.notification_type
+             UNION ALL
+            SELECT NULL::int, channel.id, TRUE, NULL, channel.channel_type,
+                   CASE WHEN channel.email_send = TRUE THEN 'email' ELSE 'inbox' END, NULL, NULL
+              FROM channels channel
+             UNION ALL
+            SELECT DISTINCT partner.id, NULL::int, TRUE, TRUE, 'channel_email', 'email', NULL, partner.email
+              FROM res_partner partner
+              JOIN mail_channel_partner member ON member.partner_id = partner.id
+              JOIN channels channel ON channel.id = member.channel_id
+             WHERE channel.email_send = TRUE AND partner.active
+        """, {
+            'subtype_id': subtype_id or None,
+            'model': self._name,
+            'res_ids': self.ids,
+            'pids': list(pids),
+            'cids': list(cids),
+        })
+        cache[key] = rows = self._cr.fetchall()
+        return rows
+
+    @api.model
+    def _notify_recipient_rows_cache(self):
+        cr = self._cr
+        if 'mail_recipient_rows' not in cr.cache:
+            cr.cache['mail_recipient_rows'] = {}
+            # the rows of a transaction are not valid in the next one
+            cr.after('commit', self._notify_invalidate_recipient_rows)
+            cr.after('rollback', self._notify_invalidate_recipient_rows)
+        return cr.cache['mail_recipient_rows']
+
+    @api.model
+    def _notify_invalidate_recipient_rows(self):
+        self._cr.cache.pop('mail_recipient_rows', None)
+
+
+class Followers(models.Model):
+
+    _inherit = 'mail.followers'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Followers, self).create(vals_list)
+
+    def write(self, vals):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Followers, self).write(vals)
+
+    def unlink(self):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Followers, self).unlink()
+
+
+class ChannelPartner(models.Model):
+
+    _inherit = 'mail.channel.partner'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(ChannelPartner, self).create(vals_list)
+
+    def write(self, vals):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(ChannelPartner, self).write(vals)
+
+    def unlink(self):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(ChannelPartner, self).unlink()
+
+
+class Channel(models.Model):
+
+    _inherit = 'mail.channel'
+
+    def write(self, vals):
+        if any(fname in vals for fname in ('channel_partner_ids', 'channel_last_seen_partner_ids', 'email_send')):
+            self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Channel, self).write(vals)
+
+
+class Partner(models.Model):
+
+    _inherit = 'res.partner'
+
+    def write(self, vals):
+        if any(fname in vals for fname in ('channel_ids', 'active', 'email', 'partner_share', 'user_ids')):
+            self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Partner, self).write(vals)
+
+
+class Users(models.Model):
+
+    _inherit = 'res.users'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        # the partners of the new users are no longer shared
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Users, self).create(vals_list)
+
+    def write(self, vals):
+        if any(fname in ('notification_type', 'groups_id', 'active', 'share', 'partner_id')
+               or fname.startswith(('in_group_', 'sel_groups_')) for fname in vals):
+            self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Users, self).write(vals)
+
+    def unlink(self):
+        self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Users, self).unlink()
+
+
+class Groups(models.Model):
+
+    _inherit = 'res.groups'
+
+    def write(self, vals):
+        if any(fname in vals for fname in ('users', 'implied_ids')):
+            self.env['mail.thread']._notify_invalidate_recipient_rows()
+        return super(Groups, self).write(vals)
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from . import test_mail_queue
+from . import test_mail_send
+from . import test_smtp_pool
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import common
+
+
+class TestMailQueue(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestMailQueue, cls).setUpClass()
+        cls.partner = cls.env['res.partner'].create({'name': 'Recipient', 'email': 'recipient@example.com'})
+        cls.IrMailServer = type(cls.env['ir.mail_server'])
+
+    def _create_mail(self, subject, scheduled_date=False):
+        return self.env['mail.mail'].create({
+            'subject': subject,
+            'body_html': '<p>Test</p>',
+            'email_from': 'sender@example.com',
+            'recipient_ids': [(4, self.partner.id)],
+            'scheduled_date': scheduled_date,
+        })
+
+    def test_process_email_queue(self):
+        now = fields.Datetime.now()
+        unscheduled = self._create_mail('Unscheduled')
+        due = self._create_mail('Due', fields.Datetime.to_string(now - timedelta(hours=1)))
+        later = self._create_mail('Later', fields.Datetime.to_string(now + timedelta(hours=1)))
+        sent = []
+
+        def send_email(server, message, *args, **kwargs):
+            sent.append(message['Subject'])
+            return message['Message-Id']
+
+        with patch.object(self.IrMailServer, 'send_email', autospec=True, side_effect=send_email):
+            self.env['mail.mail'].process_email_queue()
+        self.assertIn('Unscheduled', sent)
+        self.assertIn('Due', sent)
+        self.assertNotIn('Later', sent)
+        self.assertEqual((unscheduled | due).mapped('state'), ['sent', 'sent'])
+        self.assertEqual(later.state, 'outgoing')
+        # not claimed, another run picks it up when it is due
+        self.assertFalse(later.lease_token)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import smtplib
+from unittest.mock import patch
+
+import psycopg2
+
+from odoo.tests import common
+from odoo.tools import mute_logger
+
+
+class TestMailSend(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestMailSend, cls).setUpClass()
+        cls.env['ir.config_parameter'].sudo().set_param('mail.send.commit_size', 2)
+        cls.partner = cls.env['res.partner'].create({'name': 'Recipient', 'email': 'recipient@example.com'})
+        cls.thread = cls.env['res.partner'].create({'name': 'Thread'})
+        cls.IrMailServer = type(cls.env['ir.mail_server'])
+
+    def _create_mails(self, count):
+        return self.env['mail.mail'].create([{
+            'subject': 'Test %d' % index,
+            'body_html': '<p>Test</p>',
+            'email_from': 'sender@example.com',
+            'recipient_ids': [(4, self.partner.id)],
+        } for index in range(count)])
+
+    def _patch_send_email(self, failures=None):
+        """ Patch ir.mail_server.send_email, recording the subjects sent and
+            raising the exceptions of ``failures``, by subject. """
+        sent = []
+
+        def send_email(server, message, *args, **kwargs):
+            if failures and message['Subject'] in failures:
+                raise failures[message['Subject']]
+            sent.append(message['Subject'])
+            return message['Message-Id']
+
+        return sent, patch.object(self.IrMailServer, 'send_email', autospec=True, side_effect=send_email)
+
+    def test_send_lock_unlock(self):
+        message = self.thread.with_context(mail_notify_force_send=False).message_post(
+            body='Test', partner_ids=[self.partner.id], message_type='comment', subtype='mail.mt_comment')
+        mail = self.env['mail.mail'].search([('mail_message_id', '=', message.id)])
+        notification = self.env['mail.notification'].search([
+            ('mail_message_id', '=', message.id), ('res_partner_id', '=', self.partner.id)])
+        self.assertEqual(notification.notification_status, 'ready')
+
+        self.assertEqual(mail._send_lock_batch(), mail)
+        self.assertEqual(mail.state, 'exception')
+        self.assertEqual(notification.notification_status, 'exception')
+        # already locked, by this or another worker
+        self.assertFalse(mail._send_lock_batch())
+
+        mail._send_unlock_batch()
+        self.assertEqual(mail.state, 'outgoing')
+        self.assertFalse(mail.failure_reason)
+        self.assertEqual(notification.notification_status, 'ready')
+
+    def test_send_notification_states(self):
+        message = self.thread.with_context(mail_notify_force_send=False).message_post(
+            body='Test', partner_ids=[self.partner.id], message_type='comment', subtype='mail.mt_comment')
+        mail = self.env['mail.mail'].search([('mail_message_id', '=', message.id)])
+        notification = self.env['mail.notification'].search([
+            ('mail_message_id', '=', message.id), ('res_partner_id', '=', self.partner.id)])
+        states = []
+
+        def send_email(server, msg, *args, **kwargs):
+            # a bounce processed during the sending finds the locked state
+            self.env.cr.execute("SELECT notification_status FROM mail_notification WHERE id = %s", [notification.id])
+            states.append((mail.state, self.env.cr.fetchone()[0]))
+            return msg['Message-Id']
+
+        with patch.object(self.IrMailServer, 'send_email', autospec=True, side_effect=send_email):
+            mail._send()
+        self.assertEqual(states, [('exception', 'exception')])
+        self.assertEqual(notification.notification_status, 'sent')
+
+    def test_send_concurrent(self):
+        mail = self._create_mails(1)
+        # locked by another worker since this one read it
+        self.env['mail.mail'].flush()
+        self.env.cr.execute("UPDATE mail_mail SET state = 'exception' WHERE id = %s", [mail.id])
+        sent, patcher = self._patch_send_email()
+        with patcher:
+            mail._send()
+        self.assertEqual(sent, [])
+
+    def test_send_attempt(self):
+        mails = self._create_mails(2)
+        sent = []
+
+        def send_email(server, message, *args, **kwargs):
+            # the second mail is retried and locked by another attempt
+            self.env.cr.execute("UPDATE mail_mail SET lease_token = 'other' WHERE id = %s", [mails[1].id])
+            sent.append(message['Subject'])
+            return message['Message-Id']
+
+        with patch.object(self.IrMailServer, 'send_email', autospec=True, side_effect=send_email):
+            mails._send()
+        self.assertEqual(sent, ['Test 0'])
+        self.assertEqual(mails.mapped('state'), ['sent', 'exception'])
+
+    @mute_logger('odoo.addons.odoo_email_cc_bcc.models.compose_mail')
+    def test_send_commit_groups(self):
+        mails = self._create_mails(5)
+        sent, patcher = self._patch_send_email({'Test 2': smtplib.SMTPServerDisconnected()})
+        with patcher, patch.object(self.env.cr, 'commit') as commit, self.assertRaises(smtplib.SMTPServerDisconnected):
+            mails._send(auto_commit=True)
+        self.assertEqual(sent, ['Test 0', 'Test 1'])
+        # lock of the first group, outcome of the first group with the lock of
+        # the second one, outcome of the second group after the error
+        self.assertEqual(commit.call_count, 3)
+        self.assertEqual(mails.mapped('state'), ['sent', 'sent', 'outgoing', 'outgoing', 'outgoing'])
+
+    @mute_logger('odoo.addons.odoo_email_cc_bcc.models.compose_mail')
+    def test_send_database_error(self):
+        mails = self._create_mails(4)
+        sent, patcher = self._patch_send_email({'Test 2': psycopg2.OperationalError()})
+        unlocked = []
+
+        def unlock(records):
+            unlocked.extend(records.ids)
+
+        Mail = type(self.env['mail.mail'])
+        with patcher, patch.object(self.env.cr, 'commit'), \
+                patch.object(Mail, '_send_unlock_after_error', autospec=True, side_effect=unlock), \
+                self.assertRaises(psycopg2.OperationalError):
+            mails._send(auto_commit=True)
+        self.assertEqual(sent, ['Test 0', 'Test 1'])
+        # the mail being sent stays locked, the rest of its group is unlocked
+        self.assertEqual(unlocked, mails[3].ids)
+
+    def test_send_grouped_refused(self):
+        other = self.env['res.partner'].create({'name': 'Other', 'email': 'other@example.com'})
+        mail = self._create_mails(1)
+        mail.recipient_ids |= other
+        grouped = []
+
+        def send_grouped(mail, message, smtp_session=None):
+            grouped.append(mail._send_prepare_envelope(message) + (message['To'],))
+            return message['Message-Id'], {'other@example.com'}
+
+        postprocess = []
+
+        def postprocess_sent_message(mail, success_pids, failure_reason=False, failure_type=None):
+            postprocess.append(([partner.id for partner in success_pids], failure_type))
+
+        Mail = type(self.env['mail.mail'])
+        with patch.object(Mail, '_send_grouped', autospec=True, side_effect=send_grouped), \
+                patch.object(Mail, '_postprocess_sent_message', autospec=True, side_effect=postprocess_sent_message):
+            mail._send()
+        # both recipients in the envelope only
+        (smtp_from, smtp_to_list, email_to), = grouped
+        self.assertEqual(sorted(smtp_to_list), ['other@example.com', 'recipient@example.com'])
+        self.assertEqual(email_to, 'undisclosed-recipients:;')
+        # the refused partner is not notified as sent
+        self.assertEqual(postprocess, [([self.partner.id], 'RECIPIENT')])
+
+    def test_split_refused(self):
+        Mail = self.env['mail.mail']
+        other = self.env['res.partner'].create({'name': 'Other', 'email': 'other@example.com'})
+        recipients = [
+            (self.partner, ['"Recipient" <recipient@example.com>']),
+            (other, ['"Other" <Other@example.com>']),
+            (None, ['extra@example.com']),
+        ]
+        self.assertEqual(Mail._send_split_refused(recipients, set()), ([self.partner, other], []))
+        self.assertEqual(Mail._send_split_refused(recipients, {'other@example.com'}), ([self.partner], [other]))
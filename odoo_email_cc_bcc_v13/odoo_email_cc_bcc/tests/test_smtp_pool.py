@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import smtplib
+import threading
+from email.message import Message
+
+from odoo.tests import common
+
+from ..models.compose_mail import SmtpPool
+
+
+class StubSMTP(object):
+    """ SMTP session recording the messages sent through it, failing as told
+        by the ``fail`` callback of its server. """
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def sendmail(self, smtp_from, smtp_to_list, message):
+        assert not self.closed, "sending through a closed session"
+        refused = self.server.fail(self, smtp_to_list) or {}
+        with self.server.lock:
+            self.server.sent.append((smtp_from, smtp_to_list))
+        return refused
+
+    def quit(self):
+        self.closed = True
+
+
+class StubServer(object):
+    """ Local stand-in for an SMTP server, whose ``connect`` opens sessions. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.sent = []
+
+    def connect(self, **params):
+        with self.lock:
+            session = StubSMTP(self)
+            self.sessions.append(session)
+        return session
+
+    def fail(self, session, smtp_to_list):
+        pass
+
+
+def _message(index):
+    message = Message()
+    message['Message-Id'] = '<%d@example.com>' % index
+    message.set_payload('Test %d' % index)
+    return message
+
+
+class TestSmtpPool(common.BaseCase):
+
+    def test_deliver(self):
+        server = StubServer()
+        pool = SmtpPool(server.connect, {'host': 'localhost'}, 2)
+        futures = [pool.submit('from@example.com', ['to%d@example.com' % index], _message(index))
+                   for index in range(10)]
+        self.assertEqual([future.result() for future in futures],
+                         [('<%d@example.com>' % index, set()) for index in range(10)])
+        pool.close()
+        self.assertEqual(len(server.sent), 10)
+        # the sessions are reused, and closed with the pool
+        self.assertLessEqual(len(server.sessions), 2)
+        self.assertTrue(all(session.closed for session in server.sessions))
+
+    def test_reconnect(self):
+        server = StubServer()
+        dropped = []
+
+        def fail(session, smtp_to_list):
+            if not dropped:
+                dropped.append(session)
+                raise smtplib.SMTPServerDisconnected()
+
+        server.fail = fail
+        pool = SmtpPool(server.connect, {}, 1)
+        self.assertEqual(pool.submit('from@example.com', ['to@example.com'], _message(1)).result(), ('<1@example.com>', set()))
+        pool.close()
+        # sent once, through a new session
+        self.assertEqual(server.sent, [('from@example.com', ['to@example.com'])])
+        self.assertEqual(len(server.sessions), 2)
+        self.assertTrue(dropped[0].closed)
+
+    def test_failure_isolation(self):
+        server = StubServer()
+
+        def fail(session, smtp_to_list):
+            if smtp_to_list == ['refused@example.com']:
+                raise smtplib.SMTPRecipientsRefused({'refused@example.com': (550, b'No such user')})
+
+        server.fail = fail
+        pool = SmtpPool(server.connect, {}, 1)
+        refused = pool.submit('from@example.com', ['refused@example.com'], _message(1))
+        accepted = pool.submit('from@example.com', ['to@example.com'], _message(2))
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            refused.result()
+        self.assertEqual(accepted.result(), ('<2@example.com>', set()))
+        pool.close()
+        # the session of the failure is not reused
+        self.assertEqual(len(server.sessions), 2)
+        self.assertTrue(server.sessions[0].closed)
+        self.assertEqual(server.sent, [('from@example.com', ['to@example.com'])])
+
+    def test_partially_refused(self):
+        server = StubServer()
+        server.fail = lambda session, smtp_to_list: {'refused@example.com': (550, b'No such user')}
+        pool = SmtpPool(server.connect, {}, 1)
+        future = pool.submit('from@example.com', ['to@example.com', 'refused@example.com'], _message(1))
+        self.assertEqual(future.result(), ('<1@example.com>', {'refused@example.com'}))
+        pool.close()
+        # the session is still usable
+        self.assertEqual(len(server.sessions), 1)
+
+    def test_close(self):
+        server = StubServer()
+        pool = SmtpPool(server.connect, {}, 3)
+        futures = [pool.submit('from@example.com', ['to@example.com'], _message(index)) for index in range(6)]
+        pool.close()
+        # close waits for the pending deliveries
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertTrue(all(session.closed for session in server.sessions))
+        with self.assertRaises(RuntimeError):
+            pool.submit('from@example.com', ['to@example.com'], _message(7))